@@ -0,0 +1,72 @@
+""" asyncio support for CrudViewMixin. Python 3.5+
+
+    SqlAlchemy has no asyncio API, so the database calls are still blocking.
+    The statements are built on the event loop with the same code as the sync methods,
+    and only the blocking parts (executing the statement and loading the instances) go to an executor.
+
+    This does not make the database I/O asynchronous: every database call still takes a thread of the executor,
+    so no more queries run at once than the executor has workers.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import functools
+
+from .crud import CrudViewMixin
+
+
+class AsyncCrudViewMixin(CrudViewMixin):
+    """ CrudViewMixin with coroutine variants of the _method_*() helpers
+
+        Every coroutine returns the same result as its sync counterpart.
+        The session is only used by one blocking call at a time, so the view still works with a single session.
+    """
+
+    #: Executor for the blocking database calls: a concurrent.futures.Executor, or None for the loop's default executor
+    executor = None
+
+    def _run_blocking(self, func, *args, **kwargs):
+        """ Run a blocking call in the executor
+
+        :rtype: asyncio.Future
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _get_one_async(self, query_obj, *filter, **filter_by):
+        """ Coroutine: _get_one() """
+        sql_query, projection, _, captured = self._mquery(query_obj, *filter, **filter_by)
+        instance = await self._run_blocking(self._execute, sql_query, 'one', captured)
+        return instance, projection
+
+    async def _method_list_async(self, query_obj=None, *filter, **filter_by):
+        """ Coroutine: _method_list() """
+        key, session, res = self._list_cache_get(query_obj, *filter, **filter_by)
+        if res is not None:
+            return res
+
+        sql_query, projection, mongo_query, captured = self._mquery(query_obj, *filter, **filter_by)
+        res = await self._run_blocking(self._list_results, sql_query, projection, mongo_query, captured, query_obj, *filter, **filter_by)
+        self._list_cache_set(key, session, res)
+        return res
+
+    async def _method_create_async(self, entity):
+        """ Coroutine: _method_create(). Nothing is loaded from the database. """
+        return self._method_create(entity)
+
+    async def _method_get_async(self, query_obj=None, *filter, **filter_by):
+        """ Coroutine: _method_get() """
+        return await self._get_one_async(query_obj, *filter, **filter_by)
+
+    async def _method_update_async(self, entity, *filter, **filter_by):
+        """ Coroutine: _method_update()
+
+        The history proxy and _save_hook() may load relationships: they run in the executor as well.
+        """
+        instance, _ = await self._get_one_async(None, *filter, **filter_by)
+        return await self._run_blocking(self._update_instance, entity, instance)
+
+    async def _method_delete_async(self, *filter, **filter_by):
+        """ Coroutine: _method_delete() """
+        instance, _ = await self._get_one_async(None, *filter, **filter_by)
+        return instance
@@ -1,10 +1,113 @@
 from __future__ import absolute_import
 from builtins import object
 
+from copy import copy
+try:
+    from collections.abc import Mapping
+except ImportError:  # py2
+    from collections import Mapping
+
 from sqlalchemy import inspect
 from sqlalchemy import Column
 from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.orm.base import InspectionAttr
 from sqlalchemy.orm.util import AliasedInsp
+from sqlalchemy.sql.expression import cast
+
+from .cache import LRUCache
+
+
+#: Column kinds, see ColumnInfo.kind
+COLUMN_KINDS = ('plain', 'array', 'json', 'relation')
+
+
+class ColumnInfo(object):
+    """ Column descriptor for filter criteria
+
+        Descriptors are cached by ModelPropertyBags and shared between queries: use replace() to modify one.
+    """
+
+    __slots__ = ('sql_col', 'is_array', 'is_json', 'is_relation', 'rel_name', 'is_many', 'rel_col', 'name', 'bag', 'kind')
+
+    def __init__(self, sql_col, is_array=False, is_json=False, is_relation=False, rel_name=None, is_many=False, rel_col=None,
+                 name=None, bag=None):
+        """ Init the descriptor
+
+        :param sql_col: Column expression, or the relationship for relation columns
+        :param is_array: Is it an ARRAY column?
+        :param is_json: Is it a JSON column?
+        :param is_relation: Is it a column of a related model: 'relation.column'?
+        :param rel_name: Relationship name (relation columns only)
+        :param is_many: Is it a *-to-many relationship? (relation columns only)
+        :param rel_col: Descriptor of the related model's column (relation columns only)
+        :type rel_col: ColumnInfo|None
+        :param name: Column name, as found in the bag
+        :param bag: The bag the column comes from. It caches type-coerced variants of the column
+        :type bag: DotColumnsBag|None
+        """
+        self.sql_col = sql_col
+        self.is_array = is_array
+        self.is_json = is_json
+        self.is_relation = is_relation
+        self.rel_name = rel_name
+        self.is_many = is_many
+        self.rel_col = rel_col
+        self.name = name
+        self.bag = bag
+
+        #: The kind of the column, as used by the operator table of MongoCriteria: 'relation', 'array', 'json' or 'plain'
+        self.kind = 'relation' if is_relation else 'array' if is_array else 'json' if is_json else 'plain'
+
+    def replace(self, **kwargs):
+        """ Get a copy of the descriptor with some fields replaced
+
+        :rtype: ColumnInfo
+        """
+        fields = {name: getattr(self, name) for name in self.__slots__ if name != 'kind'}
+        fields.update(kwargs)
+        return ColumnInfo(**fields)
+
+    def coerced(self, type_):
+        """ Get the column expression cast to a type
+
+        :type type_: sqlalchemy.types.TypeEngine
+        :rtype: sqlalchemy.sql.elements.Cast
+        """
+        if self.bag is None:
+            return cast(self.sql_col, type_)
+        return self.bag.coerced(self.name, type_)
+
+
+class _AliasedProperties(Mapping):
+    """ Properties of an alias, resolved from the properties of its model on first access """
+
+    def __init__(self, alias, properties):
+        """
+        :param alias: Aliased model
+        :type alias: sqlalchemy.orm.util.AliasedClass
+        :param properties: Properties of the model: { name: attribute }
+        :type properties: Mapping
+        """
+        self._alias = alias
+        self._properties = properties
+        self._resolved = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._resolved[name]
+        except KeyError:
+            prop = self._resolved[name] = getattr(self._alias, self._properties[name].key)
+            return prop
+
+    def __contains__(self, name):
+        return name in self._properties
+
+    def __iter__(self):
+        return iter(self._properties)
+
+    def __len__(self):
+        return len(self._properties)
+
 
 class _PropertiesBag(object):
     # region Protected
@@ -104,6 +207,18 @@ class ColumnsBag(_PropertiesBag):
         except KeyError:
             raise AssertionError('Unknown column: `{}`'.format(column_name))
 
+    def aliased(self, alias):
+        """ Get the same bag for an alias of the model
+
+        Column names and types are shared with this bag; columns of the alias are resolved on first access.
+
+        :type alias: sqlalchemy.orm.util.AliasedClass
+        :rtype: ColumnsBag
+        """
+        bag = copy(self)
+        bag._columns = _AliasedProperties(alias, self._columns)
+        return bag
+
 
 class PrimaryKeyBag(ColumnsBag):
     """ Primary Key Bag """
@@ -115,14 +230,53 @@ class DotColumnsBag(ColumnsBag):
         - For JSON fields: field.prop.prop -- dot-notation access to sub-properties
     """
 
+    #: The number of JSON path expressions to cache per bag, including type-coerced variants
+    json_cache_size = 256
+
+    def __init__(self, columns):
+        super(DotColumnsBag, self).__init__(columns)
+
+        #: JSON path expressions: { name: expression, (name, type): cast expression }
+        self._json_exprs = LRUCache(self.json_cache_size)
+
+    def aliased(self, alias):
+        bag = super(DotColumnsBag, self).aliased(alias)
+        bag._json_exprs = LRUCache(self.json_cache_size)
+        return bag
+
     def __getitem__(self, name):
+        if '.' in name:
+            expr = self._json_exprs.get(name)
+            if expr is not None:
+                return expr
+
         column_name, path = self._dot_notation(name)
         col = super(DotColumnsBag, self).__getitem__(column_name)
         # JSON path
         if path and self.is_column_json(column_name):
             col = col[path].astext
+            self._json_exprs.set(name, col)
         return col
 
+    def coerced(self, name, type_):
+        """ Get the column, cast to a type
+
+        Casts of JSON columns and paths are cached: coercion is applied to them in every comparison.
+
+        :param name: Column name, with dot-notation for JSON paths
+        :type name: str
+        :param type_: Target type
+        :type type_: sqlalchemy.types.TypeEngine
+        :rtype: sqlalchemy.sql.elements.Cast
+        :raises AssertionError: unknown column
+        """
+        key = (name, type_)
+        expr = self._json_exprs.get(key)
+        if expr is None:
+            expr = cast(self[name], type_)
+            self._json_exprs.set(key, expr)
+        return expr
+
 
 class RelationshipsBag(_PropertiesBag):
     """ Relationships bag with additional capabilities """
@@ -157,6 +311,16 @@ class RelationshipsBag(_PropertiesBag):
         except KeyError:
             raise AssertionError('Unknown relationship: `{}`'.format(name))
 
+    def aliased(self, alias):
+        """ Get the same bag for an alias of the model
+
+        :type alias: sqlalchemy.orm.util.AliasedClass
+        :rtype: RelationshipsBag
+        """
+        bag = copy(self)
+        bag._rels = _AliasedProperties(alias, self._rels)
+        return bag
+
 
 class ModelPropertyBags(object):
     """ Model property bags """
@@ -189,3 +353,91 @@ class ModelPropertyBags(object):
         self.nullable  =       ColumnsBag({name: c
                                            for name, c in self.columns.items()
                                            if c.nullable})
+
+        #: Column descriptors for filter criteria: { name: ColumnInfo }
+        self._column_infos = {name: ColumnInfo(col,
+                                               is_array=self.columns.is_column_array(name),
+                                               is_json=self.columns.is_column_json(name),
+                                               name=name, bag=self.columns)
+                              for name, col in self.columns.items()}
+
+        #: Column descriptors for JSON paths: { name: ColumnInfo }
+        self._json_column_infos = LRUCache(DotColumnsBag.json_cache_size)
+
+    def aliased(self, alias):
+        """ Get bags for an alias of the model
+
+        Bags of an alias are derived from the bags of its model, with no mapper inspection.
+
+        :type alias: sqlalchemy.orm.util.AliasedClass
+        :rtype: ModelPropertyBags
+        """
+        bags = copy(self)
+        bags.model = alias
+        bags.columns = self.columns.aliased(alias)
+        bags.relations = self.relations.aliased(alias)
+        bags.pk = self.pk.aliased(alias)
+        bags.nullable = self.nullable.aliased(alias)
+        bags._column_infos = {}  # built on demand: plain columns are handled by _make_column_info()
+        bags._json_column_infos = LRUCache(DotColumnsBag.json_cache_size)
+        return bags
+
+    def column_info(self, name):
+        """ Get the column descriptor for a filter key
+
+        Supports columns, JSON paths ('column.key'), columns of related models ('relation.column'),
+        and other model attributes, like hybrid properties.
+        Descriptors are memoized. JSON paths are arbitrary, so their descriptors are kept in a bounded cache.
+
+        :param name: Column name
+        :type name: str
+        :rtype: ColumnInfo
+        :raises AssertionError: unknown column
+        """
+        try:
+            return self._column_infos[name]
+        except KeyError:
+            pass
+
+        info = self._json_column_infos.get(name)
+        if info is None:
+            info = self._make_column_info(name)
+            if info.is_relation or '.' not in name:
+                self._column_infos[name] = info
+            else:
+                self._json_column_infos.set(name, info)
+        return info
+
+    def _make_column_info(self, name):
+        """ Build a column descriptor for a name that's not memoized yet
+
+        :rtype: ColumnInfo
+        """
+        # Column of a related model
+        rel_name = name.split('.')[0]
+        if rel_name in self.relations:
+            attr = name.split('.')[1]
+            relation = self.relations[rel_name]
+            if relation.property.uselist:
+                rel_col_sql = relation.property.argument.columns.get(attr)
+            else:
+                rel_col_sql = getattr(relation.property.argument, attr)
+            rel_col = ColumnInfo(rel_col_sql,
+                                 is_array=self.columns._is_column_array(rel_col_sql),
+                                 is_json=self.columns._is_column_json(rel_col_sql))
+            return ColumnInfo(relation, is_relation=True,
+                              rel_name=rel_name,
+                              is_many=relation.property.uselist,
+                              rel_col=rel_col)
+
+        # JSON path
+        try:
+            col = self.columns[name]
+        except AssertionError as e:
+            # Other model attributes: hybrid properties, etc
+            col = getattr(self.model, name, None)
+            if col is None or not isinstance(col, InspectionAttr):
+                raise e
+            return ColumnInfo(col)
+        return ColumnInfo(col, self.columns.is_column_array(name), self.columns.is_column_json(name),
+                          name=name, bag=self.columns)
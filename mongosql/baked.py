@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from builtins import object
+
+import itertools
+from copy import deepcopy
+
+from sqlalchemy.ext import baked
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.sqltypes import NULLTYPE
+
+from .cache import LRUCache
+from .plan import parametrize_query_object, query_object_shape
+from .query import MongoQuery
+
+
+class MongoBakery(object):
+    """ Cache of complete statements built from Query Objects
+
+        Every Query Object shape is built once into a baked query (see sqlalchemy.ext.baked):
+        repeated queries of the same shape skip both the query building and the SQL compilation,
+        and only bind their values.
+
+        Only plain initial queries are baked: a query with a session and no criteria.
+        Keyset pagination and estimated counts are not baked: see bakeable_query_object()
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, size=200):
+        """ Create a bakery
+
+        :param size: The number of Query Object shapes to keep
+        :type size: int
+        """
+        #: Baked queries: { shape: _BakedEntry }
+        self._entries = LRUCache(size)
+
+        # SqlAlchemy keeps compiled query contexts and compiled SQL in here:
+        # a few entries per shape, e.g. first() slices the query
+        self._bakery = baked.BakedQuery.bakery(size=size * 3)
+
+    @staticmethod
+    def bakeable(query):
+        """ Can the initial query be baked?
+
+        A baked query is built only once, so any values used in its criteria would be frozen.
+        Only queries with no criteria can be baked.
+
+        :type query: sqlalchemy.orm.Query
+        :rtype: bool
+        """
+        return query.session is not None and query._criterion is None
+
+    @staticmethod
+    def bakeable_query_object(query_obj):
+        """ Can the Query Object be baked?
+
+        Keyset cursors are not bound: every cursor would make a new shape.
+        Estimated counts are not executed as a query.
+
+        :type query_obj: dict
+        :rtype: bool
+        """
+        return not (query_obj.get('after') or query_obj.get('before') or query_obj.get('count') == 'estimate')
+
+    def mquery(self, mongomodel, query, query_obj=None, filter_by=None):
+        """ Get a baked query for the Query Object
+
+        :param mongomodel: Model
+        :type mongomodel: mongosql.MongoModel
+        :param query: Initial query: it has to be the same for all queries of this bakery, up to the session
+        :type query: sqlalchemy.orm.Query
+        :param query_obj: Query Object
+        :type query_obj: dict|None
+        :param filter_by: Equality criteria for the model columns, sent as bound parameters
+        :type filter_by: dict|None
+        :return: Baked query, or None when the query can't be baked
+        :rtype: BakedMongoQuery|None
+        :raises AssertionError: invalid Query Object
+        """
+        query_obj = query_obj or {}
+        filter_by = filter_by or {}
+
+        try:
+            shape, values = query_object_shape(query_obj)
+            key = (mongomodel.model, shape, tuple(sorted(filter_by)))
+            hash(key)
+        except TypeError:
+            key = None  # unhashable values in the Query Object
+
+        if key is None or not self.bakeable(query) or not self.bakeable_query_object(query_obj):
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._bake(mongomodel, query, query_obj, filter_by)
+            self._entries.set(key, entry)
+
+        params = dict(zip(entry.param_names, values))
+        params.update(('mqb_' + name, value) for name, value in filter_by.items())
+        return BakedMongoQuery(entry, query.session, params)
+
+    def _bake(self, mongomodel, query, query_obj, filter_by):
+        """ Build the query for the Query Object and bake it """
+        # Replace values with bound parameters
+        param_names = []
+
+        def param(value):
+            name = 'mqb{}'.format(len(param_names))
+            param_names.append(name)
+            return bindparam(name, value, type_=NULLTYPE)
+
+        query_obj = parametrize_query_object(query_obj, param)
+
+        # Build
+        query = query.filter_by(**{name: bindparam('mqb_' + name) for name in filter_by})
+        mq = MongoQuery(mongomodel, query, plan_cache=False).query(**query_obj)
+        projection = mq.get_project()
+        # The bakery outlives the session: don't keep it, nor its identity map
+        end_query = mq.end().with_session(None)
+
+        # Bake
+        bq = self._bakery(lambda session: end_query.with_session(session), next(self._ids))
+        return _BakedEntry(bq, tuple(param_names), projection)
+
+    def clear(self):
+        """ Forget all baked queries """
+        self._entries.clear()
+        self._bakery.cache.clear()
+
+    def stats(self):
+        """ Get bakery statistics
+
+        :return: { hits, misses, size, maxsize, compiled }, where `compiled` is
+            the number of compiled contexts and SQL statements cached by SqlAlchemy
+        :rtype: dict
+        """
+        stats = self._entries.stats()
+        stats['compiled'] = len(self._bakery.cache)
+        return stats
+
+
+class _BakedEntry(object):
+    """ A baked query for a Query Object shape """
+
+    __slots__ = ('bq', 'param_names', 'projection')
+
+    def __init__(self, bq, param_names, projection):
+        self.bq = bq
+        self.param_names = param_names
+        self.projection = projection
+
+
+class BakedMongoQuery(object):
+    """ MongoQuery served from a bakery
+
+        Provides the same end() and get_project() as MongoQuery
+    """
+
+    def __init__(self, entry, session, params):
+        self._entry = entry
+        self._session = session
+        self._params = params
+
+    def end(self):
+        """ Get the baked query, ready for execution
+
+        :rtype: sqlalchemy.ext.baked.Result
+        """
+        return self._entry.bq(self._session).params(**self._params)
+
+    def get_project(self):
+        """ Get the projection of the Query Object
+
+        :rtype: dict
+        """
+        return deepcopy(self._entry.projection)
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from builtins import object
+
+from collections import OrderedDict
+
+from sqlalchemy.sql import func, visitors
+from sqlalchemy.sql.expression import bindparam, BindParameter
+
+from .crud import CrudHelper, _fetch, _list_results
+from .query import MongoQuery
+
+
+class MongoBatch(object):
+    """ A batch of Query Objects, executed together
+
+        Dashboards run lots of small queries against different models. A batch builds them all,
+        executes them with a single session, and merges the compatible ones:
+        plain counts of the same model become a single statement:
+
+            SELECT count(*) FILTER (WHERE ...), count(*) FILTER (WHERE ...) FROM t
+
+        Results come back in the order the queries were added.
+
+        Example:
+
+            batch = MongoBatch(ssn)
+            batch.add(User, {'count': 1})
+            batch.add(User, {'filter': {'age': {'$gte': 18}}, 'count': 1})
+            batch.add(article_crudhelper, {'sort': ['id-'], 'limit': 10})
+            (n_users, _), (n_adults, _), (articles, projection) = batch.execute()
+    """
+
+    def __init__(self, session):
+        """ Create a batch
+
+        :param session: The session to execute the queries with
+        :type session: sqlalchemy.orm.Session
+        """
+        self.session = session
+        self._queries = []
+
+    def add(self, model, query_obj=None):
+        """ Add a Query Object to the batch
+
+        :param model: The model to query, or a CrudHelper (its limits apply)
+        :type model: sqlalchemy.ext.declarative.DeclarativeMeta|mongosql.CrudHelper
+        :param query_obj: Query Object
+        :type query_obj: dict|None
+        :return: The index of the result
+        :rtype: int
+        :raises AssertionError: invalid Query Object
+        """
+        query_obj = query_obj or {}
+        if isinstance(model, CrudHelper):
+            mquery = lambda query_obj, estimate=True: model.mquery(self.session.query(model.model), query_obj, estimate=estimate)
+        else:
+            mquery = lambda query_obj, estimate=True: MongoQuery.get_for(model, self.session.query(model)).query(**query_obj)
+        self._queries.append((mquery(query_obj), query_obj, mquery))
+        return len(self._queries) - 1
+
+    def execute(self):
+        """ Execute the batch
+
+        :return: [ (result, projection) ], in the order the queries were added.
+            The results are the same as CrudViewMixin._method_list() gives:
+            a list of instances, a count, a list of dicts (aggregate, rows), a dict of columns (columnar),
+            or a tuple (list, total) (with_total)
+        :rtype: list
+        """
+        results = [None] * len(self._queries)
+
+        # Merge plain counts, by model
+        counts = OrderedDict()
+        for i, (mq, query_obj, _) in enumerate(self._queries):
+            if getattr(mq, 'plain_count', False) and not mq.estimated:
+                counts.setdefault(mq._model.model, []).append(i)
+        for model, indexes in counts.items():
+            if len(indexes) > 1:
+                for i, n in zip(indexes, self._merged_count(model, indexes)):
+                    results[i] = (n, None)
+
+        # Execute the rest
+        for i, (mq, query_obj, mquery) in enumerate(self._queries):
+            if results[i] is None:
+                results[i] = _results(mq, query_obj, mquery)
+        return results
+
+    def _merged_count(self, model, indexes):
+        """ Count with a single statement: one count(*) FILTER (WHERE ...) per query
+
+        :return: Counts
+        :rtype: tuple
+        """
+        columns = []
+        for i in indexes:
+            query = self._queries[i][0]._counted_query
+            if query._criterion is None:
+                columns.append(func.count())
+            else:
+                columns.append(func.count().filter(_bind_values(query._criterion, query._params)))
+        return tuple(self.session.query(*columns).select_from(model).one())
+
+
+def _bind_values(criterion, params):
+    """ Give every bound parameter of the criterion its value, and make it unique
+
+    Queries of the same shape share the names of their bound parameters (see the query plan cache),
+    so they have to be renamed before they can be used in the same statement.
+    """
+    def replace(elem):
+        if isinstance(elem, BindParameter):
+            return bindparam(elem.key, params.get(elem.key, elem.value), type_=elem.type, unique=True)
+    return visitors.replacement_traverse(criterion, {}, replace)
+
+
+def _results(mq, query_obj, mquery):
+    """ Execute a query of the batch
+
+    :param mquery: Build a MongoQuery for a Query Object: for the separate, exact count of an empty `with_total` page
+    :rtype: (list|dict|int|(list, int), dict|None)
+    """
+    if getattr(mq, 'estimated', False):
+        return mq.estimate_count(), None
+
+    sql_query = mq.end()
+    count = lambda count_obj: mquery(count_obj, estimate=False).end().scalar()
+    return _list_results(_fetch(sql_query, query_obj), mq.get_project(), query_obj, count)
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from builtins import object
+
+from collections import OrderedDict
+from threading import RLock
+
+
+class LRUCache(object):
+    """ Thread-safe LRU cache with hit/miss counters
+
+        A cache with `maxsize=0` is disabled: it never stores anything.
+    """
+
+    def __init__(self, maxsize=128):
+        """ Init the cache
+
+        :param maxsize: The maximum number of entries to keep
+        :type maxsize: int
+        """
+        assert isinstance(maxsize, int) and maxsize >= 0, 'Cache size must be a non-negative integer'
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+        #: The number of successful lookups
+        self.hits = 0
+
+        #: The number of failed lookups
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        """ Get the maximum number of entries
+
+        :rtype: int
+        """
+        return self._maxsize
+
+    @property
+    def enabled(self):
+        """ Is the cache enabled?
+
+        :rtype: bool
+        """
+        return self._maxsize > 0
+
+    def resize(self, maxsize):
+        """ Change the maximum number of entries, evicting the oldest ones when shrinking
+
+        Use `resize(0)` to disable the cache.
+
+        :type maxsize: int
+        """
+        assert isinstance(maxsize, int) and maxsize >= 0, 'Cache size must be a non-negative integer'
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        """ Get a value from the cache, marking it as recently used
+
+        :param key: Cache key
+        :type key: collections.Hashable
+        :param default: The value to return when the key is not cached
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Put a value into the cache, evicting the least recently used entries
+
+        :param key: Cache key
+        :type key: collections.Hashable
+        """
+        with self._lock:
+            if not self._maxsize:
+                return
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Remove a value from the cache
+
+        :param key: Cache key
+        :type key: collections.Hashable
+        """
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """ Remove all entries and reset the counters """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Get cache statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self._maxsize,
+            }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
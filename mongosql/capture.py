@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+from builtins import object
+
+import logging
+import random
+import sys
+from collections import deque
+from timeit import default_timer as timer
+
+from sqlalchemy.dialects import postgresql as pg
+
+from .cache import LRUCache
+
+PY2 = sys.version_info[0] == 2
+
+
+class CapturedQuery(object):
+    """ A statement captured by QueryCapture """
+
+    __slots__ = ('sql', 'build_time', 'execute_time')
+
+    def __init__(self, sql, build_time=None, execute_time=None):
+        #: Rendered SQL, with parameters interpolated
+        self.sql = sql
+
+        #: Time spent building the query, seconds
+        self.build_time = build_time
+
+        #: Time spent executing the query and loading the results, seconds
+        self.execute_time = execute_time
+
+    def __repr__(self):
+        return '<CapturedQuery {!r}>'.format(self.sql)
+
+
+class QueryCapture(object):
+    """ Debug capture of the SQL statements built from Query Objects
+
+        Rendering SQL means compiling the statement once again, so nothing is rendered unless
+        the capture is enabled, or the statement is sampled.
+        Rendered statements are cached per query shape, and captures are kept in a ring buffer.
+    """
+
+    def __init__(self, enabled=False, sample_rate=0.0, size=100, render_cache_size=256, dialect=None):
+        """ Init the capture
+
+        :param enabled: Capture every statement
+        :type enabled: bool
+        :param sample_rate: When not enabled, capture this fraction of statements (0..1)
+        :type sample_rate: float
+        :param size: The number of captured statements to keep
+        :type size: int
+        :param render_cache_size: The number of rendered statements to cache
+        :type render_cache_size: int
+        :param dialect: The dialect to render SQL with. Default: PostgreSQL
+        :type dialect: sqlalchemy.engine.interfaces.Dialect|None
+        """
+        assert 0.0 <= sample_rate <= 1.0, 'sample_rate must be within 0..1'
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.dialect = dialect or pg.dialect()
+
+        #: Captured statements, most recent last
+        self.captures = deque(maxlen=size)
+
+        #: Rendered statements: { query shape: (sql template, params) }
+        self.render_cache = LRUCache(render_cache_size)
+
+    def sampled(self):
+        """ Should the next statement be captured?
+
+        :rtype: bool
+        """
+        return self.enabled or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def capture(self, query, key=None, build_time=None):
+        """ Render the statement and store it
+
+        :param query: The query to render
+        :type query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+        :param key: Query shape. When given, the rendered statement is cached under this key.
+            Values that are not a part of the shape have to be bound parameters of the query.
+        :type key: collections.Hashable|None
+        :param build_time: Time spent building the query
+        :type build_time: float|None
+        :return: The captured statement, or None when rendering has failed
+        :rtype: CapturedQuery|None
+        """
+        try:
+            sql = self.render(query, key)
+        except Exception as e:
+            logging.error('Error generate SQL string %s', e)
+            return None
+        captured = CapturedQuery(sql, build_time)
+        self.captures.append(captured)
+        return captured
+
+    def render(self, query, key=None):
+        """ Render the statement as a string, with parameters interpolated
+
+        :type query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+        :type key: collections.Hashable|None
+        :rtype: str
+        """
+        rendered = self.render_cache.get(key) if key is not None else None
+        if rendered is None:
+            rendered = self._compile(query)
+            if key is not None:
+                self.render_cache.set(key, rendered)
+
+        template, params = rendered
+        if query._params:
+            params = dict(params, **query._params)
+
+        if PY2:
+            encoding = self.dialect.encoding
+            return (template.encode(encoding) % params).decode(encoding)
+        return template % params
+
+    def _compile(self, query):
+        """ Compile the query
+
+        :return: (sql template, params)
+        :rtype: (str, dict)
+        """
+        statement = query._as_query().statement if hasattr(query, 'bq') else query.statement
+        compiled = statement.compile(dialect=self.dialect)
+        return compiled.string, compiled.params
+
+    def clear(self):
+        """ Forget captured statements """
+        self.captures.clear()
+
+    def __iter__(self):
+        return iter(self.captures)
+
+    def __len__(self):
+        return len(self.captures)
+
+
+class timed(object):
+    """ Context manager that stores the execution time of a captured statement """
+
+    __slots__ = ('captured', 'started')
+
+    def __init__(self, captured):
+        """
+        :type captured: CapturedQuery|None
+        """
+        self.captured = captured
+
+    def __enter__(self):
+        self.started = timer()
+        return self
+
+    def __exit__(self, *exc):
+        if self.captured is not None:
+            self.captured.execute_time = timer() - self.started
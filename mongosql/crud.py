@@ -3,48 +3,106 @@ from builtins import object
 from builtins import zip
 from future.utils import string_types
 
+from collections import OrderedDict
 from copy import deepcopy
-import logging
-from sqlalchemy.dialects import postgresql as pg
+from timeit import default_timer as timer
+
+from sqlalchemy import inspect
+from sqlalchemy.sql.expression import tuple_
 
 from . import MongoModel, MongoQuery
+from .baked import MongoBakery, BakedMongoQuery
+from .capture import timed
 from .hist import ModelHistoryProxy
-import sys
-
-PY2 = sys.version_info[0] == 2
+from .plan import freeze
+from .serializer import Serializer
+from .statements import MongoKeyset
 
 
 class CrudHelper(object):
     """ Crud helper functions """
 
-    def __init__(self, model):
+    def __init__(self, model, plan_cache=True, bakery_size=0):
         """ Init CRUD helper
 
         :param model: The model to work with
         :type model: type
+        :param plan_cache: Reuse query plans for Query Objects of the same shape
+        :type plan_cache: bool
+        :param bakery_size: The number of Query Object shapes to keep baked queries for. 0 to disable baking.
+        :type bakery_size: int
         """
         self.model = model
         self.mongomodel = MongoModel.get_for(self.model)
+        self._plan_cache = plan_cache
 
-    def mquery(self, query, query_obj=None):
+        #: Baked queries, or None
+        self.bakery = MongoBakery(bakery_size) if bakery_size else None
+
+    def mquery(self, query, query_obj=None, filter_by=None, estimate=True):
         """ Construct a MongoQuery for the model.
 
-        If `query` is provided, it's used for initial filtering
+        If `query` is provided, it's used for initial filtering.
+
+        When baking is enabled, and `query` has no criteria, a baked query is returned instead.
 
         :param query: Query to start with
         :type query: sqlalchemy.orm.Query
         :param query_obj: Apply initial filtering with the Query Object
         :type query_obj: dict|None
-        :rtype: mongosql.MongoQuery
+        :param filter_by: Additional filter_by() criteria
+        :type filter_by: dict|None
+        :param estimate: Allow counts to be estimated (see StrictCrudHelper). False to always count exactly
+        :type estimate: bool
+        :rtype: mongosql.MongoQuery|mongosql.baked.BakedMongoQuery
         :raises AssertionError: unknown operations specified in query_obj
         """
         assert query_obj is None or isinstance(query_obj, dict), 'Query Object should be a dict or None'
 
-        mq = MongoQuery(self.mongomodel, query)
+        if self.bakery is not None:
+            mq = self.bakery.mquery(self.mongomodel, query, query_obj, filter_by)
+            if mq is not None:
+                return mq
+
+        if filter_by:
+            query = query.filter_by(**filter_by)
+        mq = MongoQuery(self.mongomodel, query, plan_cache=self._plan_cache)
         if query_obj:
             mq = mq.query(**query_obj)
         return mq
 
+    def cursor(self, instance, query_obj=None):
+        """ Get the keyset pagination cursor that points at a row
+
+        Send it as `after` (or `before`) in the Query Object to get the next (or the previous) page.
+
+        :param instance: A row of the results
+        :param query_obj: The Query Object the row was loaded with: its `sort` defines the cursor
+        :type query_obj: dict|None
+        :rtype: str
+        """
+        return MongoKeyset((query_obj or {}).get('sort')).cursor_for(self.mongomodel.model_bag, instance)
+
+    def pk_criterion(self, pks):
+        """ Build the criterion that selects entities by their primary keys
+
+        :param pks: Primary keys: values, or tuples of values for composite keys
+        :type pks: list
+        :rtype: sqlalchemy.sql.elements.BinaryExpression
+        """
+        columns = inspect(self.model).primary_key
+        if len(columns) == 1:
+            return columns[0].in_(pks)
+        return tuple_(*columns).in_([tuple(pk) for pk in pks])
+
+    def pk_of(self, instance):
+        """ Get the primary key of an instance, in the form pk_criterion() accepts
+
+        :rtype: object|tuple
+        """
+        pk = inspect(self.model).primary_key_from_instance(instance)
+        return pk[0] if len(pk) == 1 else tuple(pk)
+
     def check_columns(self, names):
         """ Test if all column names are known
 
@@ -136,9 +194,10 @@ class StrictCrudHelper(CrudHelper):
         - Only allowed relationships can be loaded
         - Default Query Object is used
         - Limits the maximum number of items that can be retrieved when listing
+        - Limits the number of items that can be skipped: deeper pages need keyset pagination
     """
 
-    def __init__(self, model, ro_fields=(), allow_relations=(), query_defaults=None, maxitems=None):
+    def __init__(self, model, ro_fields=(), allow_relations=(), query_defaults=None, maxitems=None, plan_cache=True, bakery_size=0, max_skip=None, count_estimate=None):
         """ Init Strict CRUD helper
 
         :param model: The model to work with
@@ -156,18 +215,31 @@ class StrictCrudHelper(CrudHelper):
         :type query_defaults: dict|None
         :param maxitems: Hard limit on the number of entities that can be loaded (max value for QueryObject['limit'])
         :type maxitems: int|None
+        :param plan_cache: Reuse query plans for Query Objects of the same shape
+        :type plan_cache: bool
+        :param bakery_size: The number of Query Object shapes to keep baked queries for. 0 to disable baking.
+        :type bakery_size: int
+        :param max_skip: Hard limit on QueryObject['skip']. Deeper pages have to use keyset pagination: `after`, `before`
+        :type max_skip: int|None
+        :param count_estimate: Estimate the totals of unfiltered lists (`count: 1` with no `filter`).
+            Estimates below this number are counted exactly.
+        :type count_estimate: int|None
         """
-        super(StrictCrudHelper, self).__init__(model)
+        super(StrictCrudHelper, self).__init__(model, plan_cache=plan_cache, bakery_size=bakery_size)
 
         self._ro_fields = ro_fields if callable(ro_fields) else set(c if isinstance(c, string_types) else c.key for c in ro_fields)
         self._allowed_relations = set(c if isinstance(c, string_types) else c.key for c in allow_relations)
         self._query_defaults = query_defaults or {}
         self._maxitems = maxitems or None
+        self._max_skip = max_skip
+        self._count_estimate = count_estimate
 
         assert callable(self._ro_fields) or all(isinstance(x, string_types) for x in self._ro_fields), 'Some values in `ro_fields` were not converted to string'
         assert all(isinstance(x, str) for x in self._allowed_relations), 'Some values in `allowed_relations` were not converted to string'
         assert isinstance(self._query_defaults, dict), '`query_defaults` was not a dict'
         assert self._maxitems is None or isinstance(self._maxitems, int), '`maxitems` must be an integer'
+        assert self._max_skip is None or isinstance(self._max_skip, int), '`max_skip` must be an integer'
+        assert self._count_estimate is None or isinstance(self._count_estimate, int), '`count_estimate` must be an integer'
 
     @property
     def ro_fields(self):
@@ -211,7 +283,7 @@ class StrictCrudHelper(CrudHelper):
         # Finish
         return disallowed_relations
 
-    def mquery(self, query, query_obj=None):
+    def mquery(self, query, query_obj=None, filter_by=None, estimate=True):
         assert query_obj is None or isinstance(query_obj, dict), 'Query Object should be a dict or None'
 
         # Query defaults
@@ -224,12 +296,31 @@ class StrictCrudHelper(CrudHelper):
             if not (query_obj.get('count', 0) or query_obj.get('aggregate', 0)):  # no limits in count() and aggregate() modes
                 query_obj['limit'] = min(self._maxitems, query_obj.get('limit', self._maxitems))
 
+        # Max skip
+        if self._max_skip is not None and query_obj and (query_obj.get('skip') or 0) > self._max_skip:
+            raise AssertionError('Can not skip more than {} items: use keyset pagination (`after`, `before`)'.format(self._max_skip))
+
         # Allowed relations
         disallowed_relations = self._check_relations(self._allowed_relations, query_obj)
         assert not disallowed_relations, 'Joining to these relations is not allowed: {}'.format(disallowed_relations)
 
+        # Estimated count
+        estimate = (estimate and self._count_estimate is not None and query_obj and
+                    query_obj.get('count') in (1, True) and not query_obj.get('filter'))
+        if estimate:
+            query_obj = dict(query_obj, count='estimate')
+
         # Finish
-        return super(StrictCrudHelper, self).mquery(query, query_obj)
+        mq = super(StrictCrudHelper, self).mquery(query, query_obj, filter_by)
+        if estimate:
+            mq.estimate_exact_below = self._count_estimate
+        return mq
+
+    def cursor(self, instance, query_obj=None):
+        # Query defaults
+        if self._query_defaults:
+            query_obj = dict(list(self._query_defaults.items()) + (list(query_obj.items()) if query_obj else []))
+        return super(StrictCrudHelper, self).cursor(instance, query_obj)
 
     def create_model(self, entity):
         assert isinstance(entity, dict), 'Create model: entity should be a dict'
@@ -258,8 +349,28 @@ class CrudViewMixin(object):
     #: Set the CRUD helper object
     crudhelper = None
 
-    def __init__(self):
-        self.sqlaclhemy_queries = []
+    #: Debug capture of the SQL statements: a mongosql.capture.QueryCapture, or None to disable
+    query_capture = None
+
+    #: The number of instances loaded at once by _method_list_stream()
+    stream_chunk_size = 1000
+
+    #: The number of primary keys looked up with a single query by _method_get_many()
+    get_many_chunk_size = 500
+
+    #: Cache of _method_list() results: a mongosql.resultcache.ResultCache, or None to disable
+    result_cache = None
+
+    #: Converts the results into dicts with their projection: see _serialize()
+    serializer = Serializer()
+
+    @property
+    def sqlaclhemy_queries(self):
+        """ Get the captured SQL statements
+
+        :rtype: list[str]
+        """
+        return [c.sql for c in self.query_capture] if self.query_capture is not None else []
 
     @classmethod
     def _getCrudHelper(cls):
@@ -280,28 +391,64 @@ class CrudViewMixin(object):
     def _mquery(self, query_obj=None, *filter, **filter_by):
         """ Get a MongoQuery with initial filtering applied
 
+        When `query_capture` samples the statement, it's rendered and captured.
+        Nothing is kept on the view: pass the MongoQuery and the capture on to _execute() and _list_results(),
+        so that a view can serve concurrent requests.
+
         :param query_obj: Query Object
         :type query_obj: dict|None
         :param filter: Additional filter() criteria
         :param filter_by: Additional filter_by() criteria
-        :rtype: sqlalchemy.orm.Query, list of fields
+        :return: (query, projection, MongoQuery, captured statement or None)
+        :rtype: (sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result, dict, mongosql.MongoQuery|mongosql.baked.BakedMongoQuery, mongosql.capture.CapturedQuery|None)
         """
-        mongo_query = self._getCrudHelper().mquery(
-            self._query().filter(*filter).filter_by(**filter_by),
-            query_obj
-        )
+        capture = self.query_capture
+        if capture is None or not capture.sampled():
+            mongo_query = self._getCrudHelper().mquery(self._query().filter(*filter), query_obj, filter_by)
+            return mongo_query.end(), mongo_query.get_project(), mongo_query, None
+
+        # Build, timed
+        started = timer()
+        initial_query = self._query().filter(*filter)
+        mongo_query = self._getCrudHelper().mquery(initial_query, query_obj, filter_by)
         sqlalchemy_query = mongo_query.end()
+        build_time = timer() - started
+
+        # Capture
+        key = self._capture_key(mongo_query, initial_query, query_obj, filter_by)
+        captured = capture.capture(sqlalchemy_query, key, build_time)
+        return sqlalchemy_query, mongo_query.get_project(), mongo_query, captured
+
+    def _capture_key(self, mongo_query, initial_query, query_obj, filter_by):
+        """ Get the key to cache the rendered statement with
+
+        Baked queries have all their values bound, and share the rendering with every query of the same shape.
+        Other queries embed their values into the statement: only identical queries share the rendering,
+        and only if the initial query has no criteria that might change between requests.
+
+        :rtype: collections.Hashable|None
+        """
+        if isinstance(mongo_query, BakedMongoQuery):
+            return mongo_query._entry
+        if initial_query._criterion is not None:
+            return None
         try:
-            dialect = pg.dialect()
-            sql_query = sqlalchemy_query.statement.compile(dialect=dialect)
-            if PY2:
-                sql_str = (sql_query.string.encode(dialect.encoding) % sql_query.params).decode(dialect.encoding)
-            else:
-                sql_str = sql_query.string % sql_query.params
-            self.sqlaclhemy_queries.append(sql_str)
-        except Exception as e:
-            logging.error('Error generate SQL string %e', e)
-        return sqlalchemy_query, mongo_query.get_project()
+            key = (type(self), freeze(query_obj), freeze(sorted(filter_by.items())))
+            hash(key)
+        except TypeError:
+            return None  # unhashable values in the Query Object
+        return key
+
+    def _execute(self, sql_query, method, captured=None):
+        """ Execute the query, timing the captured statement
+
+        :type sql_query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+        :param method: Name of the query method to execute: 'all', 'one', ...
+        :type method: str
+        :param captured: The statement captured by _mquery(), or None
+        """
+        with timed(captured):
+            return getattr(sql_query, method)()
 
     def _get_one(self, query_obj, *filter, **filter_by):
         """ Utility method that fetches a single entity.
@@ -316,9 +463,9 @@ class CrudViewMixin(object):
         :raises sqlalchemy.orm.exc.MultipleResultsFound: Multiple found
         :raises AssertionError: validation errors
         """
-        sql_query, projection = self._mquery(query_obj, *filter, **filter_by)
+        sql_query, projection, _, captured = self._mquery(query_obj, *filter, **filter_by)
 
-        instance = sql_query.one()
+        instance = self._execute(sql_query, 'one', captured)
         return instance, projection
 
     def _save_hook(self, new, prev=None):
@@ -336,23 +483,147 @@ class CrudViewMixin(object):
     def _method_list(self, query_obj=None, *filter, **filter_by):
         """ Fetch the list of entitites
 
+        With `count`, the number of entities is returned instead of the list.
+        With `with_total`, it's a tuple: (list, total).
+        With `rows`, the list has dicts of the projected columns, and no projection is returned.
+        With `columnar` (`aggregate` or `rows` only), it's a dict of columns instead: { name: list of values }.
+        With `result_cache`, repeated queries are served from the cache, until their tables change.
+
         :param query_obj: Query Object
         :param filter: Additional filter() criteria
         :param filter_by: Additional filter_by() criteria
-        :rtype: list
+        :rtype: list|int|(list, int)
         :raises AssertionError: validation errors
         """
-        sql_query, projection = self._mquery(query_obj, *filter, **filter_by)
-        res = sql_query.all()
+        key, session, res = self._list_cache_get(query_obj, *filter, **filter_by)
+        if res is not None:
+            return res
 
-        # Count?
-        if query_obj and query_obj.get('count', 0):
-            return res[0][0], None  # Scalar count query
+        sql_query, projection, mongo_query, captured = self._mquery(query_obj, *filter, **filter_by)
+        res = self._list_results(sql_query, projection, mongo_query, captured, query_obj, *filter, **filter_by)
+        self._list_cache_set(key, session, res)
+        return res
+
+    def _list_cache_get(self, query_obj=None, *filter, **filter_by):
+        """ Look the results of _method_list() up in the `result_cache`
+
+        :return: (key, session, result): the key and the session to cache the result with (the key is None when it can't be cached),
+            and the cached result (None when it's not cached)
+        :rtype: (tuple|None, sqlalchemy.orm.Session|None, tuple|None)
+        """
+        cache = self.result_cache
+        if cache is None:
+            return None, None, None
+
+        initial_query = self._query().filter(*filter)
+        namespace = '{}.{}'.format(type(self).__module__, type(self).__name__)
+        key = cache.key(namespace, self._getCrudHelper().model, initial_query, query_obj, filter_by)
+        if key is None:
+            return None, None, None
+        res = cache.get(key, initial_query.session)
+        return key, initial_query.session, res
+
+    def _list_cache_set(self, key, session, res):
+        """ Put the results of _method_list() into the `result_cache`: see _list_cache_get() """
+        if key is not None:
+            self.result_cache.set(key, res, session)
+
+    def _list_results(self, sql_query, projection, mongo_query, captured, query_obj=None, *filter, **filter_by):
+        """ Execute the list query built by _mquery(), and get the results of _method_list() """
+        # Estimated count?
+        if getattr(mongo_query, 'estimated', False):
+            with timed(captured):
+                return mongo_query.estimate_count(), None
+
+        with timed(captured):
+            res = _fetch(sql_query, query_obj)
+        count = lambda count_obj: self._count_exact(count_obj, *filter, **filter_by)
+        return _list_results(res, projection, query_obj, count)
+
+    def _count_exact(self, count_obj, *filter, **filter_by):
+        """ Count the rows of a `count` Query Object exactly: the count is never estimated
+
+        Used for the total of an empty `with_total` page, which has to mean the same as `count(*) OVER ()` of a full page.
+
+        :rtype: int
+        """
+        mongo_query = self._getCrudHelper().mquery(self._query().filter(*filter), count_obj, filter_by, estimate=False)
+        return mongo_query.end().scalar()
+
+    def _method_list_stream(self, query_obj=None, *filter, **filter_by):
+        """ Fetch the list of entities in chunks, in constant memory
+
+        Rows are read from a server-side cursor, `stream_chunk_size` at a time.
+        Once a chunk is consumed, its instances are expunged from the session, so they don't pile up in the identity map.
+
+        Joined collections can not be streamed: they are loaded from multiple rows.
+
+        :param query_obj: Query Object
+        :param filter: Additional filter() criteria
+        :param filter_by: Additional filter_by() criteria
+        :return: (chunks generator, projection)
+        :rtype: (Iterator[list], dict)
+        :raises AssertionError: validation errors
+        """
+        assert not (query_obj and (query_obj.get('count', 0) or query_obj.get('with_total', 0))), \
+            'Streaming does not support `count` and `with_total`'
+        sql_query, projection, _, _ = self._mquery(query_obj, *filter, **filter_by)
+        return self._stream(sql_query, self.stream_chunk_size), projection
 
-        # Convert KeyedTuples to dicts (when aggregating)
-        if query_obj and 'aggregate' in query_obj:
-            return [dict(zip(row.keys(), row)) for row in res], None
-        return res, projection
+    def _method_export(self, sink, export, query_obj=None, *filter, **filter_by):
+        """ Export the list of entities into a file, in constant memory
+
+        The results are streamed (see _method_list_stream()) and serialized chunk by chunk.
+
+        :param sink: Binary file-like object to write to
+        :param export: The export format
+        :type export: mongosql.export.QueryExport
+        :param query_obj: Query Object
+        :param filter: Additional filter() criteria
+        :param filter_by: Additional filter_by() criteria
+        :return: The number of exported entities
+        :rtype: int
+        :raises AssertionError: validation errors
+        """
+        chunks, projection = self._method_list_stream(query_obj, *filter, **filter_by)
+        return export.write(sink, chunks, projection)
+
+    def _serialize(self, data, projection):
+        """ Convert the results of _method_list() or _method_get() into dicts with their projection
+
+        :param data: Instance, or a list of instances. Results with no projection (counts, aggregates, rows) are returned as is.
+        :param projection: Projection, as returned with the results
+        :type projection: dict|None
+        :rtype: dict|list[dict]
+        """
+        if not projection:
+            return data
+        return self.serializer.serialize(self._getCrudHelper().model, projection, data)
+
+    @staticmethod
+    def _stream(sql_query, chunk_size):
+        """ Iterate over the results in chunks with a server-side cursor, expunging every consumed chunk
+
+        :type sql_query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+        :rtype: Iterator[list]
+        """
+        stream = lambda q: q.yield_per(chunk_size).execution_options(stream_results=True)
+        if hasattr(sql_query, 'bq'):
+            sql_query = sql_query.with_post_criteria(stream)
+        else:
+            sql_query = stream(sql_query)
+
+        session = sql_query.session
+        chunk = []
+        for row in sql_query:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                _expunge(session, chunk)
+                chunk = []
+        if chunk:
+            yield chunk
+            _expunge(session, chunk)
 
     def _method_create(self, entity):
         """ Create a new entity
@@ -380,6 +651,52 @@ class CrudViewMixin(object):
         """
         return self._get_one(query_obj, *filter, **filter_by)
 
+    def _method_get_many(self, pks, query_obj=None, *filter, **filter_by):
+        """ Fetch entities by their primary keys
+
+        The keys are looked up `get_many_chunk_size` at a time with `pk IN (...)`, or `(pk1, pk2) IN (...)` for composite keys.
+        Only the projection, the filter and the joins of the Query Object are used.
+
+        Instances already in the identity map are served without touching the database,
+        unless anything can filter them out: a filter, a join, or the criteria of _query(),
+        or they don't have all the columns of the projection loaded.
+
+        :param pks: Primary keys: values, or tuples (lists) of values for composite keys
+        :type pks: list
+        :param query_obj: Query Object
+        :param filter: Additional filter() criteria
+        :param filter_by: Additional filter_by() criteria
+        :return: ((instances, missing keys), projection). Instances come in the order of `pks`; missing keys are skipped.
+        :rtype: ((list, list), dict)
+        :raises AssertionError: validation errors
+        """
+        helper = self._getCrudHelper()
+        query_obj = {k: v for k, v in (query_obj or {}).items() if k in ('project', 'filter', 'join', 'outerjoin')}
+        pks = [tuple(pk) if isinstance(pk, list) else pk for pk in pks]
+        found = {}
+        projection = None
+
+        # Identity map
+        initial_query = self._query()
+        if not (query_obj.get('filter') or query_obj.get('join') or query_obj.get('outerjoin') or
+                filter or filter_by or initial_query._criterion is not None):
+            projection = self._mquery(dict(query_obj))[1]
+            found.update(_identity_map_get(initial_query.session, helper.model, pks, projection))
+
+        # Load the rest, in chunks
+        chunk_size = min(self.get_many_chunk_size, getattr(helper, '_maxitems', None) or self.get_many_chunk_size)
+        missing = list(OrderedDict.fromkeys(pk for pk in pks if pk not in found))
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            sql_query, projection, _, captured = self._mquery(dict(query_obj), helper.pk_criterion(chunk), *filter, **filter_by)
+            for instance in self._execute(sql_query, 'all', captured):
+                found[helper.pk_of(instance)] = instance
+        if projection is None:
+            projection = self._mquery(dict(query_obj))[1]  # everything came from the identity map
+
+        return ([found[pk] for pk in pks if pk in found],
+                [pk for pk in pks if pk not in found]), projection
+
     def _method_update(self, entity, *filter, **filter_by):
         """ Update an existing entity by merging the fields
 
@@ -394,6 +711,10 @@ class CrudViewMixin(object):
         :raises AssertionError: validation errors
         """
         instance, _ = self._get_one(None, *filter, **filter_by)
+        return self._update_instance(entity, instance)
+
+    def _update_instance(self, entity, instance):
+        """ Update the loaded instance: see _method_update() """
         instance = self._getCrudHelper().update_model(entity, instance)
         self._save_hook(
             instance,
@@ -416,3 +737,169 @@ class CrudViewMixin(object):
         """
         item, _ = self._get_one(None, *filter, **filter_by)
         return item
+
+
+def _identity_map_get(session, model, pks, projection):
+    """ Get the instances that are in the identity map and have the projected columns loaded
+
+    Instances loaded with a narrower projection are skipped: every missing column would be lazy-loaded on its own.
+
+    :param projection: The projection: { name: 1 }
+    :type projection: dict
+    :return: { pk: instance }
+    :rtype: dict
+    """
+    mapper = inspect(model)
+    columns = [name for name, include in projection.items() if include and name in mapper.column_attrs]
+    found = {}
+    for pk in pks:
+        instance = session.identity_map.get(mapper.identity_key_from_primary_key(list(pk) if isinstance(pk, tuple) else [pk]))
+        if instance is None:
+            continue
+        state = inspect(instance)
+        if not (state.expired or state.expired_attributes or state.deleted) and all(name in state.dict for name in columns):
+            found[pk] = instance
+    return found
+
+
+def _fetch(sql_query, query_obj):
+    """ Execute a list query: get its rows, or its columns in the `columnar` mode (see _fetch_columns())
+
+    :type sql_query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+    :param query_obj: Query Object
+    :type query_obj: dict|None
+    :rtype: list|(list, list[list])
+    """
+    if query_obj and query_obj.get('columnar') and not query_obj.get('count', 0):
+        return _fetch_columns(sql_query)
+    return sql_query.all()
+
+
+def _fetch_columns(sql_query):
+    """ Execute an `aggregate` or `rows` query, and read the rows straight into columns
+
+    The statement is executed with the Core: the values of every row of the cursor are appended to the lists of columns,
+    with no KeyedTuple per row, and nothing to transpose afterwards.
+
+    Baked results can only be executed through the ORM (that's where their compiled statement is cached):
+    they are loaded with all(), and transposed.
+
+    :type sql_query: sqlalchemy.orm.Query|sqlalchemy.ext.baked.Result
+    :return: (column names, lists of values)
+    :rtype: (list[str], list[list])
+    """
+    if hasattr(sql_query, 'bq'):
+        rows = sql_query.all()
+        names = [d['name'] for d in sql_query._as_query().column_descriptions]
+        return names, [list(column) for column in zip(*rows)] if rows else [[] for name in names]
+
+    names = [d['name'] for d in sql_query.column_descriptions]
+    columns = [[] for name in names]
+    appends = [column.append for column in columns]
+    for row in sql_query.session.execute(sql_query.statement):
+        for append, value in zip(appends, row):
+            append(value)
+    return names, columns
+
+
+def _list_results(res, projection, query_obj, count):
+    """ Shape the rows of a list query into the results of CrudViewMixin._method_list()
+
+    :param res: The rows; (column names, columns) in the `columnar` mode: see _fetch()
+    :param projection: The projection of the query
+    :param query_obj: Query Object
+    :param count: Count the rows of a Query Object: used when an empty `with_total` page can't carry the total
+    :type count: callable
+    :return: (result, projection)
+    :rtype: (list|dict|int|(list, int), dict|None)
+    """
+    query_obj = query_obj or {}
+
+    # Count?
+    if query_obj.get('count', 0):
+        return res[0][0], None  # Scalar count query
+
+    # Page with the total?
+    if query_obj.get('with_total', 0):
+        page_total = _page_total(res, query_obj, count)
+        return page_total, (None if query_obj.get('rows') else projection)
+
+    # Columns?
+    if query_obj.get('columnar'):
+        return _row_columns(res, query_obj['columnar']), None
+
+    # Convert KeyedTuples to dicts (when aggregating, or selecting rows)
+    if 'aggregate' in query_obj or query_obj.get('rows'):
+        return _row_dicts(res), None
+    return res, projection
+
+
+def _page_total(res, query_obj, count):
+    """ Split the rows of a `with_total` query into the page and the total
+
+    Every row carries the total, so only an empty page past the end needs to count separately.
+
+    :return: (rows, total)
+    :rtype: (list|dict, int)
+    """
+    if query_obj.get('columnar'):
+        page = _row_columns(res, query_obj['columnar'], drop_last=True)
+        totals = res[1][-1]
+    else:
+        page = _row_dicts(res, drop_last=True) if query_obj.get('rows') else [row[0] for row in res]
+        totals = [row[-1] for row in res[:1]]
+    if totals:
+        return page, totals[0]
+    if not (query_obj.get('skip') or query_obj.get('after') or query_obj.get('before')):
+        return page, 0
+    # The same rows as the page, before slicing: past the same cursor
+    count_obj = {k: v for k, v in query_obj.items() if k in ('filter', 'join', 'outerjoin', 'sort', 'after', 'before')}
+    count_obj['count'] = 1
+    return page, count(count_obj)
+
+
+def _row_dicts(rows, drop_last=False):
+    """ Convert KeyedTuples into dicts
+
+    :param drop_last: Drop the last column (the total of `with_total`)
+    :rtype: list[dict]
+    """
+    if not rows:
+        return []
+    keys = rows[0].keys()
+    if drop_last:
+        keys = keys[:-1]  # zip() stops at the shortest
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def _row_columns(columns, columnar=True, drop_last=False):
+    """ Get the dict of columns
+
+    :param columns: (column names, lists of values), from _fetch_columns()
+    :param columnar: True for lists, 'numpy' for NumPy arrays
+    :param drop_last: Drop the last column (the total of `with_total`)
+    :rtype: dict
+    :raises AssertionError: NumPy is not installed
+    """
+    names, values = columns
+    if drop_last:
+        names, values = names[:-1], values[:-1]
+
+    if columnar == 'numpy':
+        try:
+            import numpy
+        except ImportError:
+            raise AssertionError('`columnar: "numpy"` is not supported: NumPy is not installed')
+        return {name: numpy.array(column) for name, column in zip(names, values)}
+    return dict(zip(names, values))
+
+
+def _expunge(session, rows):
+    """ Expunge the loaded instances from the session; other rows (aggregates) are skipped
+
+    Session.expunge() follows the `expunge` cascade, so an instance may already be gone with a previous one.
+    """
+    for row in rows:
+        state = inspect(row, raiseerr=False)
+        if state is not None and state.session is session:
+            session.expunge(row)
@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+from builtins import object
+
+import csv
+import gzip
+import io
+import sys
+
+from .serializer import Serializer, json_dumps
+
+PY2 = sys.version_info[0] == 2
+
+
+class QueryExport(object):
+    """ Export of query results: NDJSON or CSV, written incrementally to a binary file-like sink
+
+        Rows are serialized chunk by chunk into a buffer, which is flushed to the sink every `buffer_size` characters,
+        so the export never holds more than a chunk of instances and a buffer of text.
+
+        Rows are converted into dicts by a Serializer, with a function compiled once for the projection:
+
+        * NDJSON: one JSON object per line. Relations are nested objects or lists.
+        * CSV: a header line, then one line per row. Relations are JSON-encoded into their cells.
+    """
+
+    #: Supported formats
+    FORMATS = ('ndjson', 'csv')
+
+    def __init__(self, format='ndjson', compress=False, buffer_size=64 * 1024, serializer=None):
+        """ Init the export
+
+        :param format: Output format: 'ndjson' or 'csv'
+        :type format: str
+        :param compress: Gzip the output
+        :type compress: bool
+        :param buffer_size: Flush to the sink when the buffer grows beyond this number of characters
+        :type buffer_size: int
+        :param serializer: The serializer to convert rows into dicts with. Default: a new Serializer()
+        :type serializer: mongosql.serializer.Serializer|None
+        :raises AssertionError: unknown format
+        """
+        assert format in self.FORMATS, 'Export: unsupported format "{}"'.format(format)
+        self.format = format
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.serializer = serializer or Serializer()
+
+    def write(self, sink, chunks, projection):
+        """ Write the rows to the sink
+
+        :param sink: Binary file-like object. It's not closed.
+        :param chunks: Rows, in chunks
+        :type chunks: Iterable[list]
+        :param projection: Projection, as given by MongoQuery.get_project()
+        :type projection: dict
+        :return: The number of rows written
+        :rtype: int
+        """
+        out = gzip.GzipFile(fileobj=sink, mode='wb') if self.compress else sink
+        try:
+            return self._write(out, chunks, projection)
+        finally:
+            if self.compress:
+                out.close()
+
+    def _write(self, out, chunks, projection):
+        """ Serialize the rows, flushing the buffer into `out` """
+        buffer = io.BytesIO() if PY2 else io.StringIO()
+        serialize = _row_serializer(self.serializer, projection)
+        writer = _NdjsonWriter(buffer, serialize) if self.format == 'ndjson' else _CsvWriter(buffer, serialize, projection)
+
+        n = 0
+        for chunk in chunks:
+            for row in chunk:
+                writer.writerow(row)
+            n += len(chunk)
+            if buffer.tell() >= self.buffer_size:
+                _flush(buffer, out)
+        writer.finish()
+        _flush(buffer, out)
+        return n
+
+
+class _NdjsonWriter(object):
+    """ Writes rows as JSON objects, one per line """
+
+    def __init__(self, buffer, serialize):
+        self.buffer = buffer
+        self.serialize = serialize
+
+    def writerow(self, row):
+        self.buffer.write(json_dumps(self.serialize(row)))
+        self.buffer.write('\n')
+
+    def finish(self):
+        pass
+
+
+class _CsvWriter(object):
+    """ Writes rows as CSV lines, after a header """
+
+    def __init__(self, buffer, serialize, projection):
+        self.writer = csv.writer(buffer)
+        self.serialize = serialize
+        self.projection = projection
+        self.header = False
+
+    def writerow(self, row):
+        data = self.serialize(row)
+        if not self.header:
+            self._header(data.keys())
+        self.writer.writerow([_csv_cell(v) for v in data.values()])
+
+    def finish(self):
+        if not self.header:
+            self._header([key for key, value in self.projection.items() if value])
+
+    def _header(self, names):
+        self.writer.writerow([_csv_cell(name) for name in names])
+        self.header = True
+
+
+def _row_serializer(serializer, projection):
+    """ Get a function that converts a row into a dict: an instance, or a KeyedTuple (aggregates, rows)
+
+    The model is only known from the rows, so the compiled functions are looked up by the class of the row.
+    """
+    compiled = {}
+
+    def serialize(row):
+        if hasattr(row, 'keys'):
+            return dict(zip(row.keys(), row))
+        cls = type(row)
+        try:
+            return compiled[cls](row)
+        except KeyError:
+            compiled[cls] = serializer.compile(cls, projection)
+            return compiled[cls](row)
+    return serialize
+
+
+def _csv_cell(value):
+    """ Convert a value into a CSV cell: relations and JSON columns are JSON-encoded """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json_dumps(value)
+    if PY2 and isinstance(value, unicode):  # noqa: F821
+        return value.encode('utf-8')
+    return value
+
+
+def _flush(buffer, out):
+    """ Move the buffer contents into the output """
+    data = buffer.getvalue()
+    if data:
+        out.write(data if PY2 else data.encode('utf-8'))
+    buffer.seek(0)
+    buffer.truncate()
@@ -1,42 +1,115 @@
 from __future__ import absolute_import
 from builtins import object
 
+import logging
+from threading import RLock
+from timeit import default_timer as timer
+
 from sqlalchemy import inspect, event
+from sqlalchemy.orm import configure_mappers, Mapper
+from sqlalchemy.orm.util import AliasedInsp
 
-from .statements import MongoProjection, MongoSort, MongoGroup, MongoCriteria, MongoJoin, MongoAggregate
+from .statements import MongoProjection, MongoSort, MongoGroup, MongoCriteria, MongoJoin, MongoAggregate, MongoHaving
 from .bag import ModelPropertyBags
+from .cache import LRUCache
 
 
 class MongoModel(object):
     """ Sqlalchemy Model wrapper that generates query chunks """
 
+    #: Default size of the query plan cache. Set to 0 to disable plan caching for new models
+    plan_cache_size = 256
+
+    #: MongoModels of mapped classes: { mapper: MongoModel }
+    _registry = {}
+    _registry_lock = RLock()
+
+    #: MongoModels of aliases: { alias: MongoModel }. Aliases of joined relations are reused, see MongoJoin.aliases
+    _aliases = LRUCache(1024)
+
     @classmethod
     def get_for(cls, model):
         """ Get MongoModel for a model.
 
-        Attempts to use `mongomodel` property of the model
+        MongoModels are kept in a registry, one per mapper, and are created on first access.
+        MongoModels of aliases are derived from the MongoModel of their model, and are cached as well.
 
-        :param model: Model
-        :type model: mongosql.MongoSqlBase|sqlalchemy.ext.declarative.DeclarativeMeta
+        :param model: Model, or an alias
+        :type model: mongosql.MongoSqlBase|sqlalchemy.ext.declarative.DeclarativeMeta|sqlalchemy.orm.util.AliasedClass
         :rtype: MongoModel
         """
+        mapper = inspect(model)
+        if isinstance(mapper, AliasedInsp):
+            mongomodel = cls._aliases.get(model)
+            if mongomodel is None:
+                mongomodel = cls.get_for(mapper.mapper.class_).aliased(model)
+                cls._aliases.set(model, mongomodel)
+            return mongomodel
+
         try:
-            return model.mongomodel()
-        except AttributeError:
-            model.mongomodel = MongoModel(model)
-            return model.mongomodel
+            return cls._registry[mapper]
+        except KeyError:
+            with cls._registry_lock:
+                # Another thread might have got here first
+                if mapper not in cls._registry:
+                    cls._registry[mapper] = cls(mapper.class_)
+                return cls._registry[mapper]
 
-    def __init__(self, model):
+    @classmethod
+    def warm_up(cls, base):
+        """ Create MongoModels for all mapped classes of a declarative base
+
+        Building MongoModels involves mapper inspection, which is better done at startup
+        than on the first request.
+
+        :param base: Declarative base, or a list of models
+        :type base: sqlalchemy.ext.declarative.api.DeclarativeMeta|Iterable
+        :return: { models: the number of models, seconds: time taken }
+        :rtype: dict
+        """
+        started = timer()
+        configure_mappers()
+
+        if hasattr(base, '_decl_class_registry'):
+            models = [m for m in base._decl_class_registry.values() if hasattr(m, '__mapper__')]
+        else:
+            models = list(base)
+        for model in models:
+            cls.get_for(model)
+
+        seconds = timer() - started
+        logging.info('MongoModel warm-up: %d models in %.3fs', len(models), seconds)
+        return {'models': len(models), 'seconds': seconds}
+
+    def __init__(self, model, plan_cache_size=None, model_bag=None):
         """ Create MongoSql from a model
 
             :type model: sqlalchemy.ext.declarative.declarative_base
             :param model: The model to build queries for
+            :type plan_cache_size: int | None
+            :param plan_cache_size: The number of query plans to cache. Default: MongoModel.plan_cache_size
+            :type model_bag: mongosql.bag.ModelPropertyBags | None
+            :param model_bag: Property bags of the model, if already built
         """
         #: The model we're working with
         self.__model = model
 
         #: Property bags
-        self.__bag = ModelPropertyBags(model)
+        self.__bag = model_bag or ModelPropertyBags(model)
+
+        #: Query plans: { Query Object shape: mongosql.plan.QueryPlan }
+        self.__plans = LRUCache(self.plan_cache_size if plan_cache_size is None else plan_cache_size)
+
+    def aliased(self, alias):
+        """ Get MongoModel for an alias of the model
+
+        Property bags are derived from the bags of this model.
+        Fragments built for an alias can only be used with that very alias, so it has no plan cache.
+
+        :type alias: sqlalchemy.orm.util.AliasedClass
+        :rtype: MongoModel
+        """
+        return type(self)(alias, plan_cache_size=0, model_bag=self.__bag.aliased(alias))
 
     @property
     def model(self):
@@ -52,6 +125,16 @@ class MongoModel(object):
         """
         return self.__bag
 
+    @property
+    def plan_cache(self):
+        """ Get the cache of query plans
+
+        Use `plan_cache.resize(0)` to disable plan caching for this model.
+
+        :rtype: mongosql.cache.LRUCache
+        """
+        return self.__plans
+
     #region Wrappers
 
     def project(self, projection, as_relation):
@@ -151,20 +234,23 @@ class MongoModel(object):
             self.skip(skip)
         )
 
-    def join(self, relnames, as_relation, callback):
+    def join(self, relnames, as_relation, callback, alias_key=None):
         """ Build eager loader for the relations
 
             :type relnames: None | Iterable[str] | dict
             :param relnames: List of relations to load eagerly
             :param as_relation: Load interface to chain the loader options from
             :type as_relation: sqlalchemy.orm.Load
+            :param alias_key: Cache key prefix for the aliases of the relations: (join types, relationship path).
+                None to create new aliases.
+            :type alias_key: tuple | None
             :returns: Join params list
                 Usage: don't ask :)
             :returns: (list[query-options], list[(join, query-dict)])
             :rtype: list[mongosql.statements._MongoJoinParams]
             :raises AssertionError: invalid input
         """
-        return MongoJoin(relnames)(self, as_relation, callback)
+        return MongoJoin(relnames)(self, as_relation, callback, alias_key)
 
     def aggregate(self, agg_spec):
         """ Select aggregated results
@@ -180,4 +266,28 @@ class MongoModel(object):
         """
         return MongoAggregate(agg_spec)(self)
 
+    def having(self, criteria, selectables):
+        """ Build filtering condition for aggregated results
+
+            :param criteria: The criteria to filter with, see :cls:MongoHaving
+            :type criteria: None | dict
+            :param selectables: The aggregation, as built by aggregate()
+            :type selectables: list[sqlalchemy.sql.elements.ColumnElement]
+            :rtype: sqlalchemy.sql.elements.BooleanClauseList
+            :returns: Filtering conditions.
+                Usage:
+                    a = MongoModel(User).aggregate({ n: { $sum: 1 } })
+                    h = MongoModel(User).having({ n: { $gt: 1 } }, a)
+                    query.add_columns(*a).having(h)
+            :raises AssertionError: invalid input
+            :raises AssertionError: unknown column name
+        """
+        return MongoHaving(criteria)(self, selectables)
+
     #endregion
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _clear_aliases():
+    """ Mappers were reconfigured: MongoModels of aliases might be stale """
+    MongoModel._aliases.clear()
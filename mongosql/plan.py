@@ -0,0 +1,214 @@
+from __future__ import absolute_import
+from builtins import object
+from future.utils import string_types
+
+import itertools
+from numbers import Number
+
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.sqltypes import NULLTYPE
+
+
+#: Criteria operators whose operand can be replaced with a bound parameter
+BINDABLE_OPERATORS = frozenset(('$eq', '$ne', '$lt', '$lte', '$gt', '$gte'))
+
+#: Criteria operators that take a list, every item of which can be replaced with a bound parameter
+BINDABLE_LIST_OPERATORS = frozenset(('$in', '$nin', '$all'))
+
+#: Boolean operators of the criteria
+BOOLEAN_OPERATORS = frozenset(('$or', '$and', '$nor'))
+
+
+class Placeholder(object):
+    """ A literal value in the shape of a Query Object
+
+        Placeholders of the same type are equal: the value itself is not a part of the shape.
+    """
+    __slots__ = ('type',)
+
+    def __init__(self, type):
+        self.type = type
+
+    def __eq__(self, other):
+        return isinstance(other, Placeholder) and self.type is other.type
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((Placeholder, self.type))
+
+    def __repr__(self):
+        return '<{}>'.format(self.type.__name__)
+
+
+def is_bindable(value):
+    """ Can the value be sent as a bound parameter without changing the SQL?
+
+    Booleans and None are not bindable: they produce different SQL (`IS NULL`, `= true`).
+
+    :rtype: bool
+    """
+    return isinstance(value, (Number, string_types)) and not isinstance(value, bool)
+
+
+def parametrize_criteria(criteria, param):
+    """ Copy the criteria, replacing bindable operands with `param(value)`
+
+    Operands are visited in a stable order, which is the order of the bound parameters.
+
+    :param criteria: Filter criteria
+    :type criteria: dict
+    :param param: Callback that gets a literal value and returns its replacement
+    :type param: callable
+    :rtype: dict
+    """
+    if not isinstance(criteria, dict):
+        return criteria  # invalid: leave it to MongoCriteria to complain
+
+    ret = type(criteria)()
+    for key, value in criteria.items():
+        if key in BOOLEAN_OPERATORS:
+            if isinstance(value, (list, tuple)):
+                value = [parametrize_criteria(c, param) for c in value]
+        elif key == '$not':
+            value = parametrize_criteria(value, param)
+        elif isinstance(value, dict):
+            value = type(value)(
+                (op, _parametrize_operand(op, operand, param))
+                for op, operand in value.items()
+            )
+        else:
+            value = _parametrize_operand('$eq', value, param)  # implicit equality
+        ret[key] = value
+    return ret
+
+
+def parametrize_query_object(query_obj, param):
+    """ Copy the Query Object, replacing bindable filter operands with `param(value)`
+
+    Query Objects of joined relations are handled as well.
+
+    :param query_obj: Query Object
+    :type query_obj: dict
+    :param param: Callback that gets a literal value and returns its replacement
+    :type param: callable
+    :rtype: dict
+    """
+    if not isinstance(query_obj, dict):
+        return query_obj
+
+    ret = dict(query_obj)
+    if 'filter' in ret:
+        ret['filter'] = parametrize_criteria(ret['filter'], param)
+    for op in ('join', 'outerjoin'):
+        if isinstance(ret.get(op), dict):
+            ret[op] = {relname: parametrize_query_object(qo, param)
+                       for relname, qo in ret[op].items()}
+    return ret
+
+
+def _parametrize_operand(op, operand, param):
+    """ Replace the operand of a criteria operator with a parameter, if possible """
+    if op in BINDABLE_OPERATORS and is_bindable(operand):
+        return param(operand)
+    if op in BINDABLE_LIST_OPERATORS and isinstance(operand, (list, tuple)):
+        return [param(v) if is_bindable(v) else v for v in operand]
+    return operand
+
+
+def freeze(value, sort_keys=False):
+    """ Convert a Query Object value into a hashable shape
+
+    :param sort_keys: Sort the keys of dicts, so that dicts that only differ in the order of the keys are equal
+    :type sort_keys: bool
+    :raises TypeError: the value is not hashable
+    """
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: item[0]) if sort_keys else value.items()
+        return (dict, tuple((k, freeze(v, sort_keys)) for k, v in items))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(freeze(v, sort_keys) for v in value))
+    hash(value)
+    return (type(value), value)
+
+
+def criteria_shape(criteria):
+    """ Get the shape of filter criteria and the values of its parameters
+
+    :type criteria: dict|None
+    :return: (shape, values)
+    :rtype: (tuple, list)
+    :raises TypeError: the criteria is not hashable
+    """
+    return _shape(parametrize_criteria, criteria)
+
+
+def query_object_shape(query_obj):
+    """ Get the shape of a Query Object, including joined Query Objects, and the values of its parameters
+
+    :type query_obj: dict
+    :return: (shape, values)
+    :rtype: (tuple, list)
+    :raises TypeError: the Query Object is not hashable
+    """
+    return _shape(parametrize_query_object, query_obj)
+
+
+def _shape(parametrize, obj):
+    """ Parametrize the object with placeholders, and freeze it """
+    values = []
+
+    def param(value):
+        values.append(value)
+        return Placeholder(type(value))
+
+    return freeze(parametrize(obj, param)), values
+
+
+class QueryPlan(object):
+    """ SQL fragments built for a Query Object shape
+
+        Every operation of the Query Object is built once, and then reused
+        by every Query Object of the same shape.
+        Literal values from the filter are sent as bound parameters.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, param_count=0):
+        """ Create an empty plan
+
+        :param param_count: The number of bound parameters in the filter
+        :type param_count: int
+        """
+        #: Unique plan id, used to name bound parameters
+        self.id = next(self._ids)
+
+        #: Built fragments: { operation name: fragment }
+        self.fragments = {}
+
+        #: Names of the bound parameters, in the order of criteria_shape() values
+        self.param_names = tuple('mq{}_{}'.format(self.id, i) for i in range(param_count))
+
+    def template(self, criteria):
+        """ Replace literals in the criteria with bound parameters named after this plan
+
+        The parameters are created with the current values, so the result is usable as is.
+
+        :param criteria: Filter criteria
+        :type criteria: dict
+        :return: Criteria with bound parameters
+        :rtype: dict
+        """
+        names = iter(self.param_names)
+        # NULLTYPE makes the parameter adopt the type of the column it's compared to, just like a literal does
+        return parametrize_criteria(criteria, lambda value: bindparam(next(names), value, type_=NULLTYPE))
+
+    def bind(self, values):
+        """ Get the bound parameters for the values
+
+        :type values: list
+        :rtype: dict
+        """
+        return dict(zip(self.param_names, values))
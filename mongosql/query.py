@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 from builtins import object
 
+from sqlalchemy import inspect
 from sqlalchemy.orm import Query, Load, defaultload, undefer
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import tuple_
 
 from .model import MongoModel
-from .utils import outer_with_filter
+from .statements import MongoProjection, MongoKeyset
+from .plan import QueryPlan, criteria_shape, freeze
+from .utils import outer_with_filter, estimate_rows, estimate_table_rows
 
 
 class JoinedQuery(object):
@@ -26,6 +30,8 @@ class JoinedQuery(object):
         joined = cls(mjp, join_func)
         if mjp.query is None:
             joined.query = MongoQuery.get_for(mjp.target_model)
+            if mjp.project:
+                joined.query.set_project(joined.query._project_columns(mjp.project)[1])
             joined.processed = True
         return joined
 
@@ -37,7 +43,7 @@ class JoinedQuery(object):
         model_alias = mjp.rel_alias
         if join_func == 'outerjoin' and mjp.query and mjp.query.get('filter'):
             outer_filter = mjp.query.pop('filter')
-            c = MongoModel(model_alias).filter(outer_filter)
+            c = MongoModel.get_for(model_alias).filter(outer_filter)
             query_with_joined = outer_with_filter(parent_query._query, model_alias, mjp.relationship, c)
         else:
             query_with_joined = getattr(parent_query._query, join_func)(model_alias, mjp.relationship)
@@ -49,7 +55,9 @@ class JoinedQuery(object):
             query_with_joined,
             _as_relation=mjp.relationship,
             join_path=parent_query.join_path + (mjp.relationship, ),
-            aliased=model_alias
+            join_funcs=parent_query.join_funcs + (join_func, ),
+            aliased=model_alias,
+            plan_cache=parent_query.plan_cache
         )
         for_join.on_join(parent_query.join_hook)
         for_join_query = for_join.query(**mjp.query)
@@ -73,6 +81,9 @@ class JoinedQuery(object):
 class MongoQuery(object):
     """ MongoDB-style queries """
 
+    #: Estimated counts below this number are counted exactly: see estimate_count()
+    estimate_exact_below = 1000
+
     @classmethod
     def get_for(cls, model, *args, **kwargs):
         """ Get MongoQuery for a model.
@@ -88,7 +99,7 @@ class MongoQuery(object):
         except AttributeError:
             return cls(MongoModel.get_for(model), *args, **kwargs)
 
-    def __init__(self, model, query=None, _as_relation=None, join_path=None, aliased=None):
+    def __init__(self, model, query=None, _as_relation=None, join_path=None, aliased=None, plan_cache=True, join_funcs=None):
         """ Init a MongoDB-style query
         :param model: MongoModel
         :type model: mongosql.MongoModel
@@ -98,6 +109,10 @@ class MongoQuery(object):
             Internal argument used when working with deeper relations:
             is used as initial path for defaultload(_as_relation).lazyload(...).
         :type _as_relation: sqlalchemy.orm.relationships.RelationshipProperty
+        :param plan_cache: Use the query plan cache of the model in query()
+        :type plan_cache: bool
+        :param join_funcs: Join types ('join', 'outerjoin') of the relations along the `join_path`
+        :type join_funcs: tuple
         """
         if query is None:
             query = Query([model.model])
@@ -108,9 +123,10 @@ class MongoQuery(object):
         # but if you run single test - it pass. So we create MongoModel for alias
         # here instead of "get_for".
         if aliased:
-            self._model = MongoModel(aliased)
+            self._model = MongoModel.get_for(aliased)
         self._query = query
         self.join_path = join_path or ()
+        self.join_funcs = join_funcs or ()
 
         if join_path:
             self._as_relation = defaultload(*join_path)
@@ -122,6 +138,90 @@ class MongoQuery(object):
         self._project = {}
         self._end_query = None
 
+        # Select the total number of rows along with every row? see with_total()
+        self._with_total = False
+
+        # Select the projected columns instead of instances? see rows()
+        self._rows = False
+        # The columns of the projection
+        self._columns = None
+
+        # The aggregation, for having()
+        self._aggregate = None
+
+        # The query being counted, in the count() mode
+        self._counted_query = None
+        #: Is it a plain `SELECT count(*) FROM t WHERE ...`? Such counts can be merged: see mongosql.batch
+        self.plain_count = False
+        #: Is the count estimated? see count()
+        self.estimated = False
+
+        # Sort spec of the Query Object, for keyset cursors
+        self._sort_spec = None
+        # Keyset pagination goes backwards: rows are read in reverse order
+        self._keyset_reversed = False
+
+        #: Use the query plan cache?
+        self.plan_cache = plan_cache
+        # The plan being used by query(), and its bound parameters
+        self._plan = None
+        self._plan_params = None
+
+    def _fragment(self, name, build):
+        """ Get a query fragment from the current plan, or build it
+
+        :param name: Fragment name
+        :type name: str
+        :param build: Callable that builds the fragment
+        :type build: callable
+        """
+        if self._plan is None:
+            return build()
+        fragments = self._plan.fragments
+        if name not in fragments:
+            fragments[name] = build()
+        return fragments[name]
+
+    def _project_columns(self, projection):
+        """ Get the list of columns to load and the projected properties
+
+        :rtype: (list, dict)
+        """
+        projection = MongoProjection(projection).projection
+        columns, projected_properties = MongoProjection.columns(self._model.model_bag, projection)
+        return list(columns), projected_properties
+
+    def _get_plan(self, filter, **operations):
+        """ Get the query plan for the Query Object operations
+
+        :param filter: Filter criteria
+        :param operations: Other operations that produce cacheable fragments
+        :return: (plan, params, cache key), or None when the plan cache can't be used.
+            The cache key is None when the plan is already cached.
+        :rtype: (mongosql.plan.QueryPlan, dict, tuple|None) | None
+        """
+        cache = self._model.plan_cache
+        if not self.plan_cache or not cache.enabled:
+            return None
+
+        try:
+            filter_shape, values = criteria_shape(filter)
+            key = (filter_shape, freeze(operations))
+        except TypeError:
+            return None  # unhashable values in the Query Object
+
+        plan = cache.get(key)
+        if plan is None:
+            plan = QueryPlan(len(values))
+        else:
+            key = None
+        params = plan.bind(values)
+
+        # The same plan can't be used twice in a query: parameter names would clash
+        if not params.keys().isdisjoint(self._query._params):
+            return None
+        return plan, params, key
+
     def on_join(self, on_join):
         self.join_hook = on_join
 
@@ -139,8 +239,9 @@ class MongoQuery(object):
 
     def aggregate(self, agg_spec):
         """ Select aggregated results """
-        a = self._model.aggregate(agg_spec)
+        a = self._fragment('aggregate', lambda: self._model.aggregate(agg_spec))
         if a:
+            self._aggregate = a
             self._query = self._query.with_entities(*a)
             # When no model criteria is specified, like COUNT(*), SqlAlchemy won't set the FROM clause
             # Thus, we need to explicitly set the `FROM` clause in these cases
@@ -151,7 +252,10 @@ class MongoQuery(object):
 
     def project(self, projection):
         """ Apply a projection to the query """
-        p, projected_properties = self._model.project(projection, as_relation=self._as_relation)
+        # Loader options share state with the loader of this query, so only the columns are cached
+        columns, projected_properties = self._fragment('project', lambda: self._project_columns(projection))
+        p = [self._as_relation.load_only(c) for c in columns]
+        self._columns = columns
         if self._model.model.__name__ == 'User':
             assert 1
         self._query = self._query.options(p)
@@ -160,21 +264,62 @@ class MongoQuery(object):
 
     def sort(self, sort_spec):
         """ Apply sorting to the query """
-        s = self._model.sort(sort_spec)
+        s = self._fragment('sort', lambda: self._model.sort(sort_spec))
         self._query = self._query.order_by(*s)
         self._order_by = s
         return self
 
+    def keyset(self, sort_spec, after=None, before=None, order=True):
+        """ Apply sorting with keyset pagination: continue after (or before) the cursor
+
+        The primary key is appended to the sort. Use cursor() to get the cursor for a row.
+
+        :param order: Apply the sorting. False to only select the rows past the cursor, e.g. to count them
+        :type order: bool
+        """
+        keyset = MongoKeyset(sort_spec, after, before)
+        bag = self._model.model_bag
+        if keyset.cursor:
+            self._query = self._query.filter(keyset.criterion(bag))
+        if order:
+            order_by, query_order_by = self._fragment('keyset-before' if keyset.before else 'keyset',
+                                                      lambda: keyset.order_by(bag))
+            self._query = self._query.order_by(*query_order_by)
+            self._order_by = order_by
+            self._keyset_reversed = keyset.before
+        return self
+
+    def cursor(self, instance):
+        """ Get the keyset pagination cursor that points at a row of the results
+
+        Send it as `after` to get the next page, or as `before` to get the previous page.
+
+        :param instance: A row of the results
+        :rtype: str
+        """
+        return MongoKeyset(self._sort_spec).cursor_for(self._model.model_bag, instance)
+
     def group(self, group_spec):
         """ Apply grouping to the query """
-        g = self._model.group(group_spec)
+        g = self._fragment('group', lambda: self._model.group(group_spec))
         self._query = self._query.group_by(*g)
         return self
 
+    def having(self, criteria):
+        """ Filter the aggregated results: criteria on the computed fields of aggregate() """
+        assert self._aggregate is not None, '`having` can only be used with `aggregate`'
+        h = self._fragment('having', lambda: self._model.having(criteria, self._aggregate))
+        self._query = self._query.having(h)
+        return self
+
     def filter(self, criteria):
         """ Add criteria to the query """
-        c = self._model.filter(criteria)
-        self._query = self._query.filter(c)
+        if self._plan is None:
+            c = self._model.filter(criteria)
+            self._query = self._query.filter(c)
+        else:
+            c = self._fragment('filter', lambda: self._model.filter(self._plan.template(criteria)))
+            self._query = self._query.filter(c).params(**self._plan_params)
         return self
 
     def limit(self, limit=None, skip=None, force=False):
@@ -192,7 +337,9 @@ class MongoQuery(object):
     def _join(self, relnames, join_func):
         """ Base for join and outerjoin """
 
-        for mjp in self._model.join(relnames, as_relation=self._as_relation, callback=self.join_hook):
+        # The same path joined differently is a different join: the join types of the parents are a part of the key
+        alias_key = self.join_funcs + (join_func,) + tuple(rel.property for rel in self.join_path)
+        for mjp in self._model.join(relnames, as_relation=self._as_relation, callback=self.join_hook, alias_key=alias_key):
             self.join_queries.append(JoinedQuery.from_mjp(mjp, join_func))
         self._query = self._query.options([self._as_relation.lazyload('*')])
         self._query = self._query.with_labels()
@@ -209,14 +356,115 @@ class MongoQuery(object):
         """ Use outerjoin when there is queries on relations"""
         return self._join(relnames, 'outerjoin')
 
-    def count(self):
-        """ Count rows instead """
-        self._query = self.end(count=True)
-        self._end_query = self._query.from_self(func.count(1))
+    def count(self, estimate=False):
+        """ Count rows instead
+
+        :param estimate: The count is going to be estimated with estimate_count().
+            end() still gives the exact counting query.
+        :type estimate: bool
+        """
+        self._query = self._counted_query = self.end(count=True)
+        self._end_query = self._count_query(self._query)
+        self.estimated = estimate
         self.join(())
         return self
 
-    def query(self, project=None, sort=None, group=None, filter=None, skip=None, limit=None, join=None, aggregate=None, count=False, outerjoin=None, **__unk):
+    def estimate_count(self, exact_below=None):
+        """ Estimate the number of rows, PostgreSQL
+
+        With no criteria, it's the number of rows in the table according to the statistics (pg_class.reltuples);
+        with no statistics, the rows are counted exactly.
+        Otherwise, it's the planner's estimate for the query (EXPLAIN).
+        Estimates of small numbers are rough, so below `exact_below` the rows are counted exactly.
+
+        :param exact_below: Count exactly when the estimate is below this number. Default: `estimate_exact_below`
+        :type exact_below: int|None
+        :rtype: int
+        """
+        assert self._counted_query is not None, 'estimate_count() is only available in the count() mode'
+        query = self._counted_query
+        if exact_below is None:
+            exact_below = self.estimate_exact_below
+
+        if (query._criterion is None and not query._from_obj and not query._group_by and not query._distinct and
+                query._limit is None and query._offset is None):
+            n = estimate_table_rows(query.session, inspect(self._model.model).mapper.local_table)
+            if n is None:
+                return self._end_query.scalar()
+        else:
+            n = estimate_rows(query)
+
+        if n < exact_below:
+            n = self._end_query.scalar()
+        return n
+
+    def _count_query(self, query):
+        """ Compile the counting query
+
+        Only the criteria are kept: the projection, the ordering and the loader options are dropped,
+        and the rows are counted with `SELECT count(*) FROM t WHERE ...`.
+        Relation filters are EXISTS() conditions, so they never multiply the rows.
+        Joins of the initial query might: then, distinct primary keys are counted.
+
+        Queries that can't be counted directly (grouped, sliced, distinct) are wrapped in a subquery
+        that only selects the primary key, or the grouping columns.
+        Aggregated queries count their aggregated rows.
+
+        :type query: sqlalchemy.orm.Query
+        :rtype: sqlalchemy.orm.Query
+        """
+        pk = [col for name, col in self._model.model_bag.pk.items()]
+        if query._distinct or query._statement is not None or len(query._entities) != 1 or self._aggregate is not None:
+            return query.from_self(func.count(1))
+        if (query._group_by or query._having is not None or
+                query._limit is not None or query._offset is not None or
+                (query._from_obj and len(pk) != 1)):
+            return query.with_entities(*(query._group_by or pk)).from_self(func.count(1))
+
+        if query._from_obj:
+            # The initial query has joins: they may produce several rows per entity
+            return query.with_entities(func.count(pk[0].distinct())).order_by(None)
+
+        self.plain_count = True
+        count_query = Query([func.count()], session=query.session).select_from(self._model.model)
+        if query._criterion is not None:
+            count_query = count_query.filter(query._criterion)
+        return count_query.params(**query._params)
+
+    def with_total(self):
+        """ Select the total number of rows along with every row of the page
+
+        The total is counted with a window function, `count(*) OVER ()`, which counts all rows that match
+        the criteria before the page is sliced. Every result row becomes a tuple: (instance, total).
+        With keyset pagination, the cursor is a criterion too: the total is the number of rows past the cursor.
+        When the page is empty, there are no rows to carry the total: count them separately, with the same cursor.
+        """
+        self._with_total = True
+        return self
+
+    def rows(self):
+        """ Select the projected columns instead of instances
+
+        Rows are plain tuples with named columns (KeyedTuple): no instances are built, and nothing goes to the identity map.
+        Only columns can be selected: properties and relations need instances.
+        """
+        self._rows = True
+        return self
+
+    def _row_columns(self):
+        """ The columns to select in the rows() mode
+
+        :rtype: list
+        :raises AssertionError: the projection has properties that are not columns
+        """
+        bag = self._model.model_bag
+        not_columns = [name for name, v in self._project.items() if v and name not in bag.columns.names]
+        assert not not_columns, '`rows` can only select columns: {}'.format(', '.join(sorted(not_columns)))
+        if self._columns is None:
+            return [col for name, col in bag.columns.items()]
+        return self._columns
+
+    def query(self, project=None, sort=None, group=None, filter=None, skip=None, limit=None, join=None, aggregate=None, count=False, outerjoin=None, after=None, before=None, with_total=False, rows=False, columnar=False, having=None, **__unk):
         """ Build a query
         :param project: Projection spec
         :param sort: Sorting spec
@@ -227,22 +475,63 @@ class MongoQuery(object):
         :param join: Eagerly load relations
         :param outerjoin: Eagerly load relations use LEFT OUTER JOIN
         :param aggregate: Select aggregated results
-        :param count: True to count rows instead
+        :param having: Filter criteria for the aggregated results
+        :param count: True to count rows instead, 'estimate' to estimate the count (see estimate_count()).
+            With `after` or `before`, only the rows past the cursor are counted.
+        :param after: Keyset pagination: the cursor to continue after
+        :param before: Keyset pagination: the cursor to continue before
+        :param with_total: True to select the total number of rows along with every row
+        :param rows: True to select the projected columns instead of instances
+        :param columnar: Output mode of `aggregate` and `rows` results: True for a dict of lists, 'numpy' for a dict of NumPy arrays.
+            It does not change the query: see CrudViewMixin._method_list()
         :raises AssertionError: unknown Query Object operations provided (extra keys)
         :rtype: MongoQuery
         """
         assert not __unk, 'Unknown Query Object operations: {}'.format(__unk.keys())
+        keyset = bool(after or before)
+        assert not (keyset and skip), 'Keyset pagination (`after`, `before`) can not be used with `skip`'
+        assert not (with_total and (count or aggregate)), '`with_total` can not be used with `count` or `aggregate`'
+        assert not (rows and (count or aggregate or join or outerjoin)), '`rows` can not be used with `count`, `aggregate`, or joins'
+        assert columnar in (False, True, 0, 1, 'numpy'), '`columnar` must be 1, or "numpy"'
+        assert not columnar or aggregate or rows, '`columnar` can only be used with `aggregate` or `rows`'
+        if count:
+            # Rows are counted in any order; with a cursor, only the rows past it are counted
+            sort = sort if keyset else None
+        self._sort_spec = sort
+
+        # Pages are ordered like keyset pages: with the primary key that breaks ties.
+        # Otherwise, the first page has an arbitrary order of ties, and doesn't line up with the pages after its cursor.
+        keyset_order = keyset or (limit and not (count or aggregate or group) and
+                                  MongoKeyset(sort).orderable(self._model.model_bag))
+
+        # Query plan: reuse fragments built for Query Objects of the same shape
+        plan = self._get_plan(filter, project=project, aggregate=aggregate, sort=sort, group=group, having=having)
+        if plan is not None:
+            self._plan, self._plan_params, plan_key = plan
+
         q = self
-        self.skip_or_limit = skip or limit
-        if join:            q = q.join(join)
-        if outerjoin:       q = q.outerjoin(outerjoin)
-        if project:         q = q.project(project)
-        if aggregate:       q = q.aggregate(aggregate)
-        if filter:          q = q.filter(filter)
-        if not count and sort:            q = q.sort(sort)
-        if group:           q = q.group(group)
-        if skip or limit:   q = q.limit(limit, skip)
-        return q.count() if count else q
+        try:
+            self.skip_or_limit = skip or limit
+            if join:            q = q.join(join)
+            if outerjoin:       q = q.outerjoin(outerjoin)
+            if project:         q = q.project(project)
+            if aggregate:       q = q.aggregate(aggregate)
+            if filter:          q = q.filter(filter)
+            if keyset_order:    q = q.keyset(sort, after, before, order=not count)
+            elif sort:          q = q.sort(sort)
+            if group:           q = q.group(group)
+            if having:          q = q.having(having)
+            if skip or limit:   q = q.limit(limit, skip)
+            if with_total:      q = q.with_total()
+            if rows:            q = q.rows()
+        finally:
+            self._plan = self._plan_params = None
+
+        # Cache the new plan once all of its fragments are built
+        if plan is not None and plan_key is not None:
+            self._model.plan_cache.set(plan_key, plan[0])
+
+        return q.count(estimate=count == 'estimate') if count else q
 
     def end(self, count=False):
         """ Get the Query object
@@ -258,18 +547,67 @@ class MongoQuery(object):
         if self.join_queries and not count:
             if self._order_by:
                 self._query = self._query.options(*[undefer(x.key or x.element.key) for x in self._order_by])
-            if self.skip_or_limit:
+            filtered = [j for j in self.join_queries if j.has_filter()]
+            if filtered and self.skip_or_limit and not self._with_total and not self.join_path:
+                # Slice the parent rows by their primary keys
+                self = self._pk_page(filtered)
+            elif self.skip_or_limit or self._with_total:
+                # Joined rows can not be sliced or counted: work with the parent rows in a subquery
                 if any([j.has_filter() for j in self.join_queries]):
                     for joined_query in self.join_queries:
                         if joined_query.has_filter():
                             self = joined_query.apply_filter(self)
-                    skip, limit = self.skip_or_limit
-                    self = self.limit(limit, skip, force=True)
+                    if self.skip_or_limit:
+                        skip, limit = self.skip_or_limit
+                        self = self.limit(limit, skip, force=True)
+                if self._with_total:
+                    self._query = self._query.add_columns(self._total_column())
+                self._query = self._query.from_self()
+            elif self._keyset_reversed:
+                # Rows are read in reverse: put them in order outside
                 self._query = self._query.from_self()
             for joined_query in self.join_queries:
                 self = joined_query.apply(self)
             # Apply order to the resulting query
             if self._order_by is not None:
                 self._query = self._query.order_by(*self._order_by)
+        else:
+            if self._rows:
+                self._query = self._query.with_entities(*self._row_columns())
+            if self._with_total:
+                self._query = self._query.add_columns(self._total_column())
+            if self._keyset_reversed and not count:
+                # Rows are read in reverse: put them in order outside
+                self._query = self._query.from_self().order_by(*self._order_by)
         self._end_query = self._query
         return self._end_query
+
+    def _pk_page(self, filtered_joins):
+        """ Slice the parent rows when the joined relations have filters
+
+        Joined rows can't be sliced, so the page is selected by the primary keys of the parents:
+        the relation filters become semi-joins (EXISTS), and the parents are loaded with their relations
+        by `WHERE pk IN (SELECT pk ... LIMIT n)`.
+
+        :param filtered_joins: Joined relations that have filters
+        :type filtered_joins: list[JoinedQuery]
+        :rtype: MongoQuery
+        """
+        outer_query = self._query.order_by(None)
+
+        # The page of primary keys
+        for joined_query in filtered_joins:
+            self = joined_query.apply_filter(self)
+        skip, limit = self.skip_or_limit
+        self = self.limit(limit, skip, force=True)
+        pk = [col for name, col in self._model.model_bag.pk.items()]
+        page = self._query.with_entities(*pk).statement
+
+        # The parents of the page
+        self._query = outer_query.filter((pk[0] if len(pk) == 1 else tuple_(*pk)).in_(page))
+        return self
+
+    @staticmethod
+    def _total_column():
+        """ The total number of rows: see with_total() """
+        return func.count().over().label('total')
@@ -0,0 +1,309 @@
+from __future__ import absolute_import
+from builtins import object
+from future.utils import string_types
+
+import time
+import uuid
+from copy import deepcopy
+from threading import RLock
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_mapper
+from sqlalchemy.sql.util import find_tables
+
+from .cache import LRUCache
+from .plan import freeze
+
+
+class DictCacheBackend(object):
+    """ In-process cache backend: an LRU dict with per-entry TTL
+
+        A backend is any object with the same methods: get(), set(), delete(), clear().
+        Keys are hashable tuples: backends that need strings (memcached, redis) can hash their repr().
+    """
+
+    def __init__(self, maxsize=1000):
+        """ Init the backend
+
+        :param maxsize: The maximum number of entries to keep
+        :type maxsize: int
+        """
+        self._data = LRUCache(maxsize)
+
+    def get(self, key):
+        """ Get a value
+
+        :return: The value, or None when it's not cached, or has expired
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.time():
+            self._data.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        """ Put a value
+
+        :param ttl: Time to live, seconds. None: until evicted
+        :type ttl: float|None
+        """
+        self._data.set(key, (time.time() + ttl if ttl is not None else None, value))
+
+    def delete(self, key):
+        """ Remove a value """
+        self._data.pop(key)
+
+    def clear(self):
+        """ Remove all values """
+        self._data.clear()
+
+
+class ResultCache(object):
+    """ Cache of query results, invalidated when the tables they were loaded from change
+
+        Results are cached by (namespace, initial query, canonical Query Object, filter_by),
+        together with the versions of every table in the join graph of the query:
+        the tables of the initial query, the model, and the models of the joined relations.
+
+        Every flush, commit, rollback and bulk update/delete of a session bumps the versions of the tables it has changed,
+        so the entries cached with the older versions are never hit again, and are left for the backend to evict.
+        Changes made with plain SQL are not seen: they expire with the `ttl`.
+
+        A session with uncommitted changes neither gets results from the cache, nor puts them there:
+        they may have rows that other sessions should not see.
+
+        Instances are cached as detached copies: on a hit, the copies are merged into the session of the request
+        without a query (see Session.merge(load=False)).
+    """
+
+    def __init__(self, backend=None, ttl=60, sessions=Session):
+        """ Init the cache, and start watching the sessions for changes
+
+        :param backend: Cache backend. Default: DictCacheBackend()
+        :param ttl: Time to live of the results, seconds. None: until invalidated
+        :type ttl: float|None
+        :param sessions: Sessions to watch for changes: a Session class, a sessionmaker, or a scoped_session
+        """
+        self.backend = backend if backend is not None else DictCacheBackend()
+        self.ttl = ttl
+
+        #: The number of results served from the cache
+        self.hits = 0
+
+        #: The number of results not found in the cache
+        self.misses = 0
+
+        self._lock = RLock()
+        self._changes_key = ('mongosql.result_cache.changes', id(self))
+
+        self._sessions = sessions
+        for name, listener in self._listeners():
+            event.listen(sessions, name, listener)
+
+    def _listeners(self):
+        """ Session event listeners: [ (event name, listener) ] """
+        return [
+            ('after_flush', self._after_flush),
+            ('after_commit', self._after_commit),
+            ('after_rollback', self._after_rollback),
+            ('after_bulk_update', self._after_bulk),
+            ('after_bulk_delete', self._after_bulk),
+        ]
+
+    def close(self):
+        """ Stop watching the sessions for changes
+
+        The cached results can't be trusted anymore: the cache should not be used after that.
+        """
+        for name, listener in self._listeners():
+            event.remove(self._sessions, name, listener)
+
+    def key(self, namespace, model, initial_query, query_obj=None, filter_by=None):
+        """ Get the cache key of a query
+
+        The key includes the current versions of the tables, so it has to be taken before the query is executed:
+        a result stored with it is never hit if the tables change in the meantime.
+
+        :param namespace: Anything that tells the results of the same query apart, e.g. the name of the view
+        :type namespace: str
+        :param model: Model
+        :type model: sqlalchemy.ext.declarative.DeclarativeMeta
+        :param initial_query: The initial query, with all the criteria
+        :type initial_query: sqlalchemy.orm.Query
+        :param query_obj: Query Object
+        :type query_obj: dict|None
+        :param filter_by: Equality criteria
+        :type filter_by: dict|None
+        :return: Cache key, or None when the query can't be cached
+        :rtype: tuple|None
+        """
+        statement = initial_query.statement
+        compiled = statement.compile()
+        try:
+            key = (
+                namespace,
+                str(compiled),
+                freeze(sorted(compiled.params.items()), sort_keys=True),
+                freeze(query_obj or {}, sort_keys=True),
+                freeze(sorted((filter_by or {}).items()), sort_keys=True),
+            )
+            hash(key)
+        except TypeError:
+            return None  # unhashable values
+
+        tables = set(find_tables(statement)) | join_graph_tables(inspect(model), query_obj or {})
+        versions = tuple((name, self._version(name)) for name in sorted(t.fullname for t in tables))
+        return ('mongosql.result', key, versions)
+
+    def get(self, key, session):
+        """ Get a cached result
+
+        :param key: Cache key, from key()
+        :type key: tuple
+        :param session: The session to merge the cached instances into
+        :type session: sqlalchemy.orm.Session
+        :return: The result, or None when it's not cached, or the session has uncommitted changes
+        """
+        if self.has_changes(session):
+            return None
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _copy(value, lambda instance: session.merge(instance, load=False))
+
+    def set(self, key, value, session=None):
+        """ Cache a result
+
+        :param key: Cache key, from key()
+        :type key: tuple
+        :param value: The result. Instances are copied, so they can't be changed by their session.
+        :param session: The session the result was loaded with: nothing is cached while it has uncommitted changes
+        :type session: sqlalchemy.orm.Session|None
+        """
+        if session is not None and self.has_changes(session):
+            return
+        copies = Session()
+        try:
+            value = _copy(value, lambda instance: copies.merge(instance, load=False))
+        finally:
+            copies.expunge_all()
+        self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, *tables):
+        """ Invalidate all results loaded from the tables
+
+        :param tables: Tables, or their names
+        :type tables: sqlalchemy.Table|str
+        """
+        for table in tables:
+            name = table if isinstance(table, string_types) else table.fullname
+            self.backend.set(('mongosql.table', name), uuid.uuid4().hex)
+
+    def has_changes(self, session):
+        """ Does the session have uncommitted changes: pending, or flushed?
+
+        :type session: sqlalchemy.orm.Session
+        :rtype: bool
+        """
+        return bool(session.new or session.dirty or session.deleted or session.info.get(self._changes_key))
+
+    def clear(self):
+        """ Remove all results, and reset the counters """
+        self.backend.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Get cache statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def _version(self, name):
+        """ Get the current version of a table
+
+        A table with no version (never changed, or evicted) gets a new one:
+        the results cached with the old one can't be trusted.
+        """
+        version = self.backend.get(('mongosql.table', name))
+        if version is None:
+            version = uuid.uuid4().hex
+            self.backend.set(('mongosql.table', name), version)
+        return version
+
+    def _after_flush(self, session, flush_context):
+        tables = set()
+        for instance in set(session.new) | set(session.dirty) | set(session.deleted):
+            tables |= mapper_tables(object_mapper(instance))
+        # Invalidate now, for the session itself, and once again on commit:
+        # other sessions may cache the old rows until then
+        self.invalidate(*tables)
+        session.info.setdefault(self._changes_key, set()).update(tables)
+
+    def _after_commit(self, session):
+        self.invalidate(*session.info.pop(self._changes_key, ()))
+
+    def _after_rollback(self, session):
+        # The changes were seen by the session itself, and may have been cached: drop them
+        self.invalidate(*session.info.pop(self._changes_key, ()))
+
+    def _after_bulk(self, context):
+        tables = mapper_tables(context.mapper)
+        self.invalidate(*tables)
+        context.session.info.setdefault(self._changes_key, set()).update(tables)
+
+
+def mapper_tables(mapper):
+    """ Get the tables a mapper writes to: its own tables, and the secondary tables of its relationships
+
+    :type mapper: sqlalchemy.orm.Mapper
+    :rtype: set[sqlalchemy.Table]
+    """
+    tables = set(mapper.tables)
+    for relationship in mapper.relationships:
+        if relationship.secondary is not None:
+            tables.add(relationship.secondary)
+    return tables
+
+
+def join_graph_tables(mapper, query_obj):
+    """ Get the tables of a model, and of the relations joined by the Query Object, recursively
+
+    :type mapper: sqlalchemy.orm.Mapper
+    :type query_obj: dict
+    :rtype: set[sqlalchemy.Table]
+    """
+    tables = set(mapper.tables)
+    for op in ('join', 'outerjoin'):
+        joins = query_obj.get(op)
+        if isinstance(joins, string_types):
+            joins = [joins]
+        if isinstance(joins, (list, tuple)):
+            joins = dict.fromkeys(joins)
+        for name, rel_query_obj in (joins or {}).items():
+            relationship = mapper.relationships.get(name)
+            if relationship is None:
+                continue  # invalid: MongoQuery complains
+            if relationship.secondary is not None:
+                tables.add(relationship.secondary)
+            tables |= join_graph_tables(relationship.mapper, rel_query_obj if isinstance(rel_query_obj, dict) else {})
+    return tables
+
+
+def _copy(value, merge):
+    """ Copy a result, replacing instances with merge(instance) """
+    if hasattr(value, '_sa_instance_state'):
+        return merge(value)
+    if isinstance(value, list):
+        return [_copy(v, merge) for v in value]
+    if isinstance(value, tuple) and not hasattr(value, 'keys'):  # not a KeyedTuple
+        return tuple(_copy(v, merge) for v in value)
+    return deepcopy(value)
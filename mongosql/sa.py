@@ -13,16 +13,12 @@ class MongoSqlBase(object):
         Provides methods for accessing :cls:MongoModel and :cls:MongoQuery
     """
 
-    __mongomodel = None
-
     @classmethod
     def mongomodel(cls):
         """ Get MongoModel object
         :rtype: mongosql.MongoModel
         """
-        if cls.__mongomodel is None:
-            cls.__mongomodel = MongoModel(cls)
-        return cls.__mongomodel
+        return MongoModel.get_for(cls)
 
     @classmethod
     def mongoquery(cls, query=None, **kwargs):
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+from builtins import object
+
+import json
+import keyword
+import re
+
+from sqlalchemy import inspect
+
+from .cache import LRUCache
+from .plan import freeze
+
+
+class Serializer(object):
+    """ Converts instances into dicts with the projection of the Query Object
+
+        For every (model, projection), a function is generated that builds the dict in a single expression:
+
+            def serialize(row):
+                return {'id': row.id, 'title': row.title, 'comments': [serialize_comment(v) for v in row.comments]}
+
+        Functions are compiled once and cached, nested relations included.
+
+        Example:
+
+            serializer = Serializer()
+            articles, projection = view._method_list(query_obj)
+            data = serializer.serialize(Article, projection, articles)
+            body = serializer.to_json(Article, projection, articles)
+    """
+
+    def __init__(self, size=256, dumps=None):
+        """ Init the serializer
+
+        :param size: The number of compiled functions to keep
+        :type size: int
+        :param dumps: JSON encoder for to_json(): a function that gets a value and returns str or bytes,
+            e.g. `orjson.dumps`. Default: json.dumps() that encodes dates as ISO strings
+        :type dumps: callable|None
+        """
+        self.dumps = dumps or json_dumps
+        self._compiled = LRUCache(size)
+
+    def compile(self, model, projection):
+        """ Get the serializer function for the model and the projection
+
+        :param model: Model
+        :type model: sqlalchemy.ext.declarative.DeclarativeMeta
+        :param projection: Projection, as given by MongoQuery.get_project(): { name: 1 | 0 | nested projection }
+        :type projection: dict
+        :return: Function: instance -> dict
+        :rtype: callable
+        """
+        try:
+            key = (model, freeze(projection))
+            hash(key)
+        except TypeError:
+            return self._compile(model, projection)
+
+        serialize = self._compiled.get(key)
+        if serialize is None:
+            serialize = self._compile(model, projection)
+            self._compiled.set(key, serialize)
+        return serialize
+
+    def serialize(self, model, projection, data):
+        """ Serialize an instance, or a list of instances
+
+        :param data: Instance, list of instances, or None
+        :rtype: dict|list[dict]|None
+        """
+        if data is None:
+            return None
+        serialize = self.compile(model, projection)
+        if isinstance(data, (list, tuple)):
+            return [serialize(row) for row in data]
+        return serialize(data)
+
+    def to_json(self, model, projection, data):
+        """ Serialize, and encode as JSON with `dumps`
+
+        :rtype: str|bytes
+        """
+        return self.dumps(self.serialize(model, projection, data))
+
+    def _compile(self, model, projection):
+        """ Generate the serializer function """
+        relationships = inspect(model).relationships
+        namespace = {'_one': _one}
+        items = []
+        for name, value in projection.items():
+            if isinstance(value, dict):
+                relationship = relationships.get(name)
+                assert relationship is not None, 'Projection: {} is not a relationship of {}'.format(name, model.__name__)
+                fname = '_s{}'.format(len(namespace))
+                namespace[fname] = self.compile(relationship.mapper.class_, value)
+                if relationship.uselist:
+                    expr = '[{}(v) for v in {}]'.format(fname, _getattr(name))
+                else:
+                    expr = '_one({}, {})'.format(fname, _getattr(name))
+            elif value:
+                expr = _getattr(name)
+            else:
+                continue
+            items.append('{!r}: {}'.format(str(name), expr))
+
+        source = 'def serialize(row):\n    return {{{}}}\n'.format(', '.join(items))
+        exec(compile(source, '<mongosql.serializer {}>'.format(model.__name__), 'exec'), namespace)
+        return namespace['serialize']
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _getattr(name):
+    """ Source code that gets the attribute of `row` """
+    if _IDENTIFIER.match(name) and not keyword.iskeyword(name):
+        return 'row.' + name
+    return 'getattr(row, {!r})'.format(str(name))
+
+
+def _one(serialize, value):
+    """ Serialize a related object, which may be None """
+    return None if value is None else serialize(value)
+
+
+def json_default(value):
+    """ JSON-encode values that JSON does not support: dates, decimals, ... """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def json_dumps(value):
+    """ Compact JSON """
+    return json.dumps(value, default=json_default, separators=(',', ':'))
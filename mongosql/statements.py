@@ -2,18 +2,24 @@ from __future__ import absolute_import
 from builtins import object
 from future.utils import string_types
 
+import base64
+import binascii
+import json
 from collections import OrderedDict
 
-from sqlalchemy import Integer, Float
-from sqlalchemy.orm import defaultload, lazyload, contains_eager, aliased
-from sqlalchemy.orm.base import InspectionAttr
+from sqlalchemy import Integer, Float, event
+from sqlalchemy.orm import defaultload, lazyload, contains_eager, aliased, Mapper
 
-from sqlalchemy.sql.expression import and_, or_, not_, cast
+from sqlalchemy.sql.expression import and_, or_, not_, cast, tuple_
 from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter, Label
 from sqlalchemy.sql.functions import func
 
 from sqlalchemy.dialects import postgresql as pg
 
+from .bag import ColumnInfo, COLUMN_KINDS
+from .cache import LRUCache
+
 
 class MongoProjection(object):
     """ MongoDB projection operator
@@ -188,14 +194,160 @@ class MongoGroup(MongoSort):
         return self.columns(model.model_bag, self.sort)
 
 
-class ColumnInfo(object):
-    def __init__(self, sql_col, is_array=False, is_json=False, is_relation=False, **kwargs):
-        self.is_array = is_array
-        self.is_json = is_json
-        self.sql_col = sql_col
-        self.is_relation = is_relation
-        for name, value in kwargs.items():
-            setattr(self, name, value)
+class MongoKeyset(object):
+    """ Keyset pagination
+
+        A page continues from a cursor: a token holding the sort values of the last (or the first) row
+        of the previous page. The primary key is appended to the sort to make the order unique.
+
+        * { sort: [...], limit: 10, after: cursor } - the page that follows the cursor
+        * { sort: [...], limit: 10, before: cursor } - the page that precedes the cursor
+
+        Keyset columns must be plain columns with no NULL values.
+    """
+
+    def __init__(self, sort_spec, after=None, before=None):
+        """ Create the paginator
+
+            :param sort_spec: Sort spec, see :cls:MongoSort
+            :type sort_spec: None | Sequence | OrderedDict
+            :param after: Cursor to continue after
+            :type after: str | None
+            :param before: Cursor to continue before
+            :type before: str | None
+            :raises AssertionError: invalid input
+        """
+        assert not (after and before), 'Keyset: `after` and `before` can not be used together'
+        assert all(isinstance(c, string_types) for c in (after, before) if c), 'Keyset: cursor must be a string'
+
+        #: Normalized sort: { field: +1 | -1 }
+        self.sort = MongoSort(sort_spec).sort
+
+        #: The cursor to continue from
+        self.cursor = after or before
+
+        #: Going backwards?
+        self.before = bool(before)
+
+    def orderable(self, bag):
+        """ Can the rows be ordered by the keyset? Only plain columns can
+
+            :type bag: mongosql.bag.ModelPropertyBags
+            :rtype: bool
+        """
+        return all('.' not in name and name in bag.columns.names for name in self.sort)
+
+    def keys(self, bag):
+        """ Get the keyset: the sort, followed by the primary key
+
+            :type bag: mongosql.bag.ModelPropertyBags
+            :return: { column name: +1 | -1 }
+            :rtype: OrderedDict
+            :raises AssertionError: unknown column name
+        """
+        keys = OrderedDict(self.sort)
+        for name in keys:
+            assert '.' not in name and name in bag.columns.names, 'Keyset: can only sort by columns, got `{}`'.format(name)
+        for name, col in bag.pk.items():
+            keys.setdefault(col.key, +1)
+        return keys
+
+    def order_by(self, bag):
+        """ Build the ordering
+
+            :type bag: mongosql.bag.ModelPropertyBags
+            :return: (ordering of the results, ordering of the query).
+                They differ when going backwards: the query reads rows in reverse.
+            :rtype: (list, list)
+        """
+        keys = self.keys(bag)
+        order_by = MongoSort.columns(bag, keys)
+        if not self.before:
+            return order_by, order_by
+        return order_by, MongoSort.columns(bag, OrderedDict((name, -d) for name, d in keys.items()))
+
+    def criterion(self, bag):
+        """ Build the condition that selects rows past the cursor
+
+            :type bag: mongosql.bag.ModelPropertyBags
+            :rtype: sqlalchemy.sql.elements.ClauseElement
+            :raises AssertionError: invalid cursor
+        """
+        keys = self.keys(bag)
+        values = self.decode(self.cursor, list(keys))
+        assert all(v is not None for v in values), 'Keyset: can not paginate by NULL values'
+
+        columns = [bag.columns[name] for name in keys]
+        ascending = [(d == +1) != self.before for d in keys.values()]
+
+        # All columns in the same direction: a row-value comparison, which is index-friendly
+        if all(ascending) or not any(ascending):
+            if len(columns) == 1:
+                return columns[0] > values[0] if ascending[0] else columns[0] < values[0]
+            return tuple_(*columns) > tuple_(*values) if ascending[0] else tuple_(*columns) < tuple_(*values)
+
+        # Mixed directions: (a > 1) OR (a = 1 AND b < 2) OR ...
+        return or_(*[
+            and_(*[columns[j] == values[j] for j in range(i)] +
+                  [columns[i] > values[i] if ascending[i] else columns[i] < values[i]])
+            for i in range(len(columns))
+        ])
+
+    def cursor_for(self, bag, instance):
+        """ Get the cursor that points at an instance
+
+            :type bag: mongosql.bag.ModelPropertyBags
+            :param instance: A row of the results
+            :rtype: str
+        """
+        names = list(self.keys(bag))
+        return self.encode(names, [getattr(instance, name) for name in names])
+
+    @staticmethod
+    def encode(names, values):
+        """ Encode a cursor
+
+            Values that JSON does not support, like dates, are sent as strings: the database parses them.
+
+            :type names: list[str]
+            :type values: list
+            :rtype: str
+        """
+        data = json.dumps([names, values], separators=(',', ':'),
+                          default=lambda v: v.isoformat() if hasattr(v, 'isoformat') else str(v))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode(cursor, names):
+        """ Decode a cursor
+
+            :param cursor: The cursor
+            :type cursor: str
+            :param names: Keyset column names the cursor has to match
+            :type names: list[str]
+            :return: Values
+            :rtype: list
+            :raises AssertionError: invalid cursor
+        """
+        try:
+            data = base64.urlsafe_b64decode(str(cursor + '=' * (-len(cursor) % 4)))
+            cursor_names, values = json.loads(data.decode('utf-8'))
+        except (ValueError, TypeError, binascii.Error):
+            raise AssertionError('Keyset: invalid cursor')
+        assert cursor_names == names and len(values) == len(names), 'Keyset: the cursor does not match the sort'
+        return values
+
+    def __call__(self, model):
+        """ Build the statement
+
+            :type model: MongoModel
+            :return: (results ordering, query ordering, criterion or None)
+            :rtype: (list, list, sqlalchemy.sql.elements.ClauseElement|None)
+            :raises AssertionError: unknown column name, invalid cursor
+        """
+        order_by, query_order_by = self.order_by(model.model_bag)
+        criterion = self.criterion(model.model_bag) if self.cursor else None
+        return order_by, query_order_by, criterion
 
 
 def is_array(value, message=None):
@@ -247,72 +399,43 @@ class MongoCriteria(object):
         assert isinstance(criteria, dict), 'Criteria must be one of: None, dict'
         self.criteria = criteria
 
-    # Supported operation. Operation name, function that checks params,
-    # function that returns condition or another function for call with on cls and conditions.
-    # Special operation is '*', which match all operations, used for relations.
-    __operations = [
-        ('$eq', lambda column, value: not column.is_relation and column.is_array and not is_array(value), lambda cls, sql_col, value: sql_col.any(value)),
-        ('$eq', lambda column, value: not column.is_relation and not column.is_array or is_array(value), lambda cls, sql_col, value: sql_col == value),
-        ('$ne', lambda column, value: not column.is_relation and column.is_array and not is_array(value), lambda cls, sql_col, value: sql_col.all(value, operators.ne)),
-        ('$ne', lambda column, value: not column.is_relation and not column.is_array or is_array(value), lambda cls, sql_col, value: sql_col != value),
-        ('$lt', lambda column, value: not column.is_relation, lambda cls, sql_col, value: sql_col < value),
-        ('$lte', lambda column, value: not column.is_relation, lambda cls, sql_col, value: sql_col <= value),
-        ('$gt', lambda column, value: not column.is_relation, lambda cls, sql_col, value: sql_col > value),
-        ('$gte', lambda column, value: not column.is_relation, lambda cls, sql_col, value: sql_col >= value),
-        ('$in', lambda column, value: not column.is_relation and is_array(value, 'Criteria: $in argument must be a list') and column.is_array,
-                   lambda cls, sql_col, value: sql_col.overlap(value)),
-        ('$in', lambda column, value: not column.is_relation and is_array(value, 'Criteria: $in argument must be a list') and not column.is_array,
-                   lambda cls, sql_col, value: sql_col.in_(value)),
-        ('$nin', lambda column, value: not column.is_relation and is_array(value, 'Criteria: $nin argument must be a list') and column.is_array,
-                   lambda cls, sql_col, value: ~ sql_col.overlap(value)),
-        ('$nin', lambda column, value: not column.is_relation and is_array(value, 'Criteria: $nin argument must be a list') and not column.is_array,
-                   lambda cls, sql_col, value: sql_col.notin_(value)),
-        ('$exists', lambda column, value: not column.is_relation, lambda cls, sql_col, value: sql_col != None if value else sql_col == None),
-        ('$all', lambda column, value: is_array(value, 'Criteria: $all argument must be a list') and assert_true(column.is_array, 'Criteria: $all can only be applied to an array column'),
-                   lambda cls, sql_col, value: sql_col.contains(value)),
-        ('$size', lambda column, value: not column.is_relation and value == 0 and assert_true(column.is_array, 'Criteria: $all can only be applied to an array column'),
-                   lambda cls, sql_col, value: func.array_length(sql_col, 1) == None),  # ARRAY_LENGTH(field, 1) IS NULL
-        ('$size', lambda column, value: not column.is_relation and value != 0 and assert_true(column.is_array, 'Criteria: $all can only be applied to an array column'),
-                   lambda cls, sql_col, value: func.array_length(sql_col, 1) == value),  # ARRAY_LENGTH(field, 1) == value
-    ]
+    #: Operator table: { (operator, column kind): [(check, handler), ...] }
+    #: `check(column, value)` tells whether the handler applies to the value (None: it always does);
+    #: `handler(sql_col, value)` returns the condition. The first applicable handler wins.
+    #: Column kinds are: 'plain', 'array', 'json', 'relation'. See ColumnInfo.kind
+    _operators = {}
+
+    @classmethod
+    def register_op(cls, name, handler, kinds=COLUMN_KINDS, check=None):
+        """ Register an operator handler for the given column kinds
+
+        Handlers registered earlier take precedence.
+
+        :param name: Operator name, e.g. '$eq'
+        :type name: str
+        :param handler: Function that gets (sql_col, value) and returns the condition
+        :type handler: callable
+        :param kinds: Column kinds the handler applies to
+        :type kinds: Iterable[str]
+        :param check: Function that gets (column, value) and tells whether the handler applies. None: always applies
+        :type check: callable|None
+        """
+        for kind in kinds:
+            cls._operators.setdefault((name, kind), []).append((check, handler))
 
     @classmethod
     def custom_op(cls, name, func, condition=None):
-        if condition is None:
-            condition = lambda column, value: True
-        binded_func = lambda cls, sql_col, value: func(sql_col, value)
-        cls.__operations.append((name, condition, binded_func))
+        cls.register_op(name, func, check=condition)
 
     @classmethod
     def get_column(cls, bag, col_name):
-        rel_name = col_name.split('.')[0]
-        if rel_name in bag.relations:
-            attr = col_name.split('.')[1]
-            relation = bag.relations[rel_name]
-            if relation.property.uselist:
-                rel_col_sql = relation.property.argument.columns.get(attr)
-            else:
-                rel_col_sql = getattr(relation.property.argument, attr)
-            is_array = bag.columns._is_column_array(rel_col_sql)
-            is_json = bag.columns._is_column_json(rel_col_sql)
-            rel_col = ColumnInfo(rel_col_sql, is_array=is_array, is_json=is_json, is_relation=False)
-            return ColumnInfo(relation, is_array=False, is_json=False, is_relation=True,
-                              rel_name=rel_name,
-                              is_many=relation.property.uselist,
-                              rel_col=rel_col)
-        try:
-            col = bag.columns[col_name]
-        except Exception as e:
-            if getattr(bag.model, col_name, None) is None:
-                raise e
-            col = getattr(bag.model, col_name)
-            if not isinstance(col, InspectionAttr):
-                raise e
-            return ColumnInfo(col)
-        is_array = bag.columns.is_column_array(col_name)
-        is_json  = bag.columns.is_column_json(col_name)
-
-        return ColumnInfo(col, is_array, is_json)
+        """ Get the column descriptor for a filter key
+
+        :type bag: mongosql.bag.ModelPropertyBags
+        :type col_name: str
+        :rtype: mongosql.bag.ColumnInfo
+        """
+        return bag.column_info(col_name)
 
     @classmethod
     def preprocess_value_and_column(cls, column, value):
@@ -322,22 +445,27 @@ class MongoCriteria(object):
         if column.is_array and value_array:
             value = cast(pg.array(value), pg.ARRAY(column.sql_col.type.item_type))
         if column.is_json:
-            coerce_type = column.sql_col.type.coerce_compared_value('=', value)  # HACKY: use sqlalchemy type coercion
-            column.sql_col = cast(column.sql_col, coerce_type)
+            # Bound parameters from the query plan are coerced by their value
+            literal = value.value if isinstance(value, BindParameter) else value
+            coerce_type = column.sql_col.type.coerce_compared_value('=', literal)  # HACKY: use sqlalchemy type coercion
+            column = column.replace(sql_col=column.coerced(coerce_type))  # descriptors are shared: copy
 
         return column, value
 
     @classmethod
     def get_condition(cls, op, column, value):
-        column, processed_value = cls.preprocess_value_and_column(column, value)
-        for operation, check, condition in cls.__operations:
-            if op == operation:
-                if check(column, value):
-                    return condition(cls, column.sql_col, processed_value)
-            if operation == '*':
-                if check(column, value):
-                    return condition(cls, op, column.sql_col, processed_value)
-        raise AssertionError('Criteria: unsupported operator "{}"'.format(op))
+        kind = column.kind
+        handlers = cls._operators.get((op, kind), ())
+
+        # Only array and JSON columns need their operands coerced
+        processed_value = value
+        if handlers and kind != 'plain':
+            column, processed_value = cls.preprocess_value_and_column(column, value)
+
+        for check, handler in handlers:
+            if check is None or check(column, value):
+                return handler(column.sql_col, processed_value)
+        raise AssertionError('Criteria: unsupported operator "{}" for {} column'.format(op, kind))
 
     # noinspection PyComparisonWithNone
     @classmethod
@@ -431,8 +559,44 @@ class MongoCriteria(object):
         return self.statement(model.model_bag, self.criteria)
 
 
+def _register_builtin_operators():
+    """ Fill the operator table of MongoCriteria with the built-in operators """
+    register_op = MongoCriteria.register_op
+    scalar = ('plain', 'json')
+    list_arg = lambda op: lambda column, value: is_array(value, 'Criteria: {} argument must be a list'.format(op))
+
+    # Equality. For arrays: contains value, unless compared to an array
+    register_op('$eq', lambda sql_col, value: sql_col.any(value), ('array',), lambda column, value: not is_array(value))
+    register_op('$eq', lambda sql_col, value: sql_col == value, scalar + ('array',))
+    register_op('$ne', lambda sql_col, value: sql_col.all(value, operators.ne), ('array',), lambda column, value: not is_array(value))
+    register_op('$ne', lambda sql_col, value: sql_col != value, scalar + ('array',))
+
+    # Comparison
+    register_op('$lt', lambda sql_col, value: sql_col < value, scalar + ('array',))
+    register_op('$lte', lambda sql_col, value: sql_col <= value, scalar + ('array',))
+    register_op('$gt', lambda sql_col, value: sql_col > value, scalar + ('array',))
+    register_op('$gte', lambda sql_col, value: sql_col >= value, scalar + ('array',))
+
+    # Lists
+    register_op('$in', lambda sql_col, value: sql_col.overlap(value), ('array',), list_arg('$in'))
+    register_op('$in', lambda sql_col, value: sql_col.in_(value), scalar, list_arg('$in'))
+    register_op('$nin', lambda sql_col, value: ~ sql_col.overlap(value), ('array',), list_arg('$nin'))
+    register_op('$nin', lambda sql_col, value: sql_col.notin_(value), scalar, list_arg('$nin'))
+
+    # IS [NOT] NULL
+    register_op('$exists', lambda sql_col, value: sql_col != None if value else sql_col == None, scalar + ('array',))
+
+    # Arrays
+    register_op('$all', lambda sql_col, value: sql_col.contains(value), ('array',), list_arg('$all'))
+    register_op('$size', lambda sql_col, value: func.array_length(sql_col, 1) == None, ('array',), lambda column, value: value == 0)  # ARRAY_LENGTH(field, 1) IS NULL
+    register_op('$size', lambda sql_col, value: func.array_length(sql_col, 1) == value, ('array',))  # ARRAY_LENGTH(field, 1) == value
+
+
+_register_builtin_operators()
+
+
 class _MongoJoinParams(object):
-    def __init__(self, options, relationship=None, target_model=None, query=None, relname=None, rel_alias=None, additional_filter=None):
+    def __init__(self, options, relationship=None, target_model=None, query=None, relname=None, rel_alias=None, additional_filter=None, project=None):
         """ Values for joins
         :param options: Additional query options
         :type options: Sequence[sqlalchemy.orm.Load]
@@ -442,6 +606,8 @@ class _MongoJoinParams(object):
         :type target_model: sqlalchemy.ext.declarative.DeclarativeMeta
         :param query: Query dict for :meth:MongoQuery.query()
         :type query: dict
+        :param project: Projection of a relation that is loaded with no query
+        :type project: list|dict|None
         """
         self.options = options
         self.relationship = relationship
@@ -450,6 +616,7 @@ class _MongoJoinParams(object):
         self.relname = relname
         self.rel_alias = rel_alias
         self.additional_filter = additional_filter
+        self.project = project
 
 
 class MongoJoin(object):
@@ -457,8 +624,23 @@ class MongoJoin(object):
 
         - List of relation names
         - Dict: { relation-name: query-dict } for :meth:MongoQuery.query
+
+        A relation with a query-dict is joined to: its rows can be filtered.
+        A relation with no query-dict is just loaded, with a loader strategy:
+
+        - The strategy the relationship was declared with: lazy='joined', 'subquery', 'selectin'
+        - Otherwise: 'selectin' for to-many relations, 'joined' for to-one relations
+
+        'selectin' needs SqlAlchemy 1.2: older versions load with 'subquery' instead.
+
+        The strategy can be chosen with a query-dict that has only `$load`, and optionally `project`:
+
+            { comments: { $load: 'selectin', project: [...] } }
     """
 
+    #: Loader strategies for `$load`
+    LOAD_STRATEGIES = ('joined', 'selectin', 'subquery')
+
     def __init__(self, relnames):
         """ Create the joiner
 
@@ -475,11 +657,38 @@ class MongoJoin(object):
         else:
             raise AssertionError('Join must be one of: None, list, dict')
 
+    #: Aliases of joined relations: { (join types, relationship path): alias }
+    #: Cleared when mappers are reconfigured
+    aliases = LRUCache(1024)
+
     @classmethod
-    def options(cls, bag, rels, as_relation, callback):
+    def alias_for(cls, target_model, key=None):
+        """ Get an alias for a joined relation
+
+        An alias is only used once in a query, so every relationship path gets an alias of its own,
+        and the same alias is reused by all queries.
+
+        :param target_model: The model to alias
+        :param key: Cache key: (join types, relationship path). None to get a new alias
+        :type key: tuple|None
+        :rtype: sqlalchemy.orm.util.AliasedClass
+        """
+        if key is None:
+            return aliased(target_model)
+        alias = cls.aliases.get(key)
+        if alias is None:
+            alias = aliased(target_model)
+            cls.aliases.set(key, alias)
+        return alias
+
+    @classmethod
+    def options(cls, bag, rels, as_relation, callback, alias_key=None):
         """ Prepare relationships loader
         :type bag: mongosql.bag.ModelPropertyBags
         :type as_relation: sqlalchemy.orm.Load
+        :param alias_key: Cache key prefix for the aliases: (join types, relationship path).
+            None to create new aliases.
+        :type alias_key: tuple|None
         :returns: List of _MongoJoinParams
         :rtype: list[_MongoJoinParams]
         """
@@ -491,22 +700,27 @@ class MongoJoin(object):
         for relname, query in rels.items():
             rel = bag.relations[relname]
             target_model = rel.property.mapper.class_
-            rel_a = aliased(target_model)
+            rel_a = cls.alias_for(target_model, None if alias_key is None else alias_key + (rel.property,))
 
             additional_query = None
             if callback:
                 additional_query = callback(relname, rel, alias=rel_a)
                 if additional_query:
                     query = {}
+            load = project = None
+            if query is not None and '$load' in query:
+                load, project = cls._load_spec(query)
+                query = None
             if query is None:
                 # For generate the output format from get_project
-                mjp_list.append(_MongoJoinParams(None, relname=relname, target_model=target_model))
+                mjp_list.append(_MongoJoinParams(None, relname=relname, target_model=target_model, project=project))
                 # No query specified
                 # Just load this relationship
-                if rel.property.lazy == 'subquery':
-                    rel_load = as_relation.subqueryload(rel)
-                else:
-                    rel_load = as_relation.joinedload(rel)
+                rel_load = cls.loader(as_relation, rel, load)
+                if project:
+                    from .model import MongoModel  # circular import
+                    MongoProjection.options(MongoModel.get_for(target_model).model_bag,
+                                            MongoProjection(project).projection, rel_load)
                 # No query specified: do not load sub-relations
                 rel_load.lazyload('*')
             else:
@@ -523,17 +737,57 @@ class MongoJoin(object):
                 ))
         return mjp_list
 
-    def __call__(self, model, as_relation, callback):
+    @classmethod
+    def _load_spec(cls, query):
+        """ Get the loader strategy and the projection from a query-dict with `$load`
+
+        :rtype: (str, list|dict|None)
+        :raises AssertionError: invalid strategy, unsupported operations
+        """
+        load = query['$load']
+        assert load in cls.LOAD_STRATEGIES, 'Join: `$load` must be one of: {}'.format(', '.join(cls.LOAD_STRATEGIES))
+        unsupported = set(query) - {'$load', 'project'}
+        assert not unsupported, 'Join: `$load` can only be used with `project`, got: {}'.format(', '.join(sorted(unsupported)))
+        return load, query.get('project')
+
+    @staticmethod
+    def loader(as_relation, rel, load=None):
+        """ Chain the loader for a relation
+
+        :param as_relation: Load interface to chain the loader from
+        :type as_relation: sqlalchemy.orm.Load
+        :type rel: sqlalchemy.orm.attributes.InstrumentedAttribute
+        :param load: Loader strategy, or None to choose automatically
+        :type load: str|None
+        :rtype: sqlalchemy.orm.Load
+        """
+        if load is None:
+            load = rel.property.lazy
+            if load not in MongoJoin.LOAD_STRATEGIES:
+                load = 'selectin' if rel.property.uselist else 'joined'
+        if load == 'selectin' and not hasattr(as_relation, 'selectinload'):
+            load = 'subquery'  # SqlAlchemy < 1.2
+        return getattr(as_relation, load + 'load')(rel)
+
+    def __call__(self, model, as_relation, callback, alias_key=None):
         """ Build the statement
 
             :type model: MongoModel
             :param as_relation: Load interface to chain the loader options from
             :type as_relation: sqlalchemy.orm.Load
+            :param alias_key: Cache key prefix for the aliases, see options()
+            :type alias_key: tuple|None
             :return: List of join params
             :rtype: list[_MongoJoinParams]
             :raises AssertionError: unknown column name
         """
-        return self.options(model.model_bag, self.rels, as_relation, callback)
+        return self.options(model.model_bag, self.rels, as_relation, callback, alias_key)
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _clear_aliases():
+    """ Mappers were reconfigured: aliases might be stale """
+    MongoJoin.aliases.clear()
 
 
 class MongoAggregate(object):
@@ -584,7 +838,7 @@ class MongoAggregate(object):
             # Computed expression
             assert isinstance(comp_expression, dict), 'Aggregate: Expression should be either a column name, or an object'
             assert len(comp_expression) == 1, 'Aggregate: expression can only contain a single operator'
-            operator, expression = comp_expression.popitem()
+            (operator, expression), = comp_expression.items()  # don't modify the Query Object
 
             # Expression statement
             if isinstance(expression, int) and operator == '$sum':
@@ -638,4 +892,47 @@ class MongoAggregate(object):
         """
         return self.selectables(model.model_bag, self.agg_spec)
 
+
+class MongoHaving(MongoCriteria):
+    """ MongoDB criteria for aggregated results: SQL HAVING
+
+        { computed_field_name: criteria }
+
+        Keys are the computed fields of the aggregation (see :cls:MongoAggregate),
+        or columns of the model, which have to be grouped by. Supports the operators of :cls:MongoCriteria:
+
+            { n: { $gt: 100 }, $or: [ { max_age: { $lt: 18 } }, { uid: 1 } ] }
+    """
+
+    def __call__(self, model, selectables):
+        """ Build the statement
+
+            :type model: MongoModel
+            :param selectables: The aggregation, as built by :cls:MongoAggregate
+            :type selectables: list[sqlalchemy.sql.elements.ColumnElement]
+            :return: SQL statement for having()
+            :rtype: sqlalchemy.sql.elements.BooleanClauseList
+            :raises AssertionError: unknown column name
+        """
+        return self.statement(_AggregatedBag(model.model_bag, selectables), self.criteria)
+
+
+class _AggregatedBag(object):
+    """ Model bag that also knows the computed fields of the aggregation: for MongoHaving """
+
+    def __init__(self, bag, selectables):
+        self.bag = bag
+        self.labels = {s.name: s for s in selectables if isinstance(s, Label)}
+
+    def column_info(self, name):
+        """ Get the column descriptor for a computed field, or for a column of the model
+
+        :rtype: ColumnInfo
+        """
+        label = self.labels.get(name)
+        if label is None:
+            return self.bag.column_info(name)
+        # PostgreSQL can't refer to the output columns in HAVING: repeat the expression
+        return ColumnInfo(label.element, name=name)
+
 # TODO: update operations in MongoDB-style
@@ -1,10 +1,21 @@
 from __future__ import absolute_import
 
-from sqlalchemy import sql, inspection
+import json
+
+from sqlalchemy import sql, inspection, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Mapper
 
 from sqlalchemy.orm.util import ORMAdapter
 from sqlalchemy.sql import visitors
-from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import and_, Executable, ClauseElement
+
+from .cache import LRUCache
+
+
+#: Outer join targets and conditions: { (relationship, alias): (right, join condition) }
+#: Cleared when mappers are reconfigured
+_outer_joins = LRUCache(1024)
 
 
 def _add_alias(join_clause, relationship, alias):
@@ -28,6 +39,20 @@ def _add_alias(join_clause, relationship, alias):
 
 
 def outer_with_filter(query, alias, relation, filter_clause):
+    key = (relation.prop, alias)
+    join = _outer_joins.get(key)
+    if join is None:
+        join = _outer_join(alias, relation)
+        _outer_joins.set(key, join)
+    right, join_clause = join
+    return query.outerjoin(right, and_(join_clause, filter_clause))
+
+
+def _outer_join(alias, relation):
+    """ Build the target and the condition of an outer join to an alias
+
+    :return: (right, join condition)
+    """
     left = relation.prop.parent
     left_info = inspection.inspect(left)
     right_info = inspection.inspect(alias)
@@ -45,5 +70,55 @@ def outer_with_filter(query, alias, relation, filter_clause):
         right = sql.join(secondary, alias, sj)
     else:
         right = alias
-    onclause = and_(_add_alias(pj, relation, alias), filter_clause)
-    return query.outerjoin(right, onclause)
+    return right, _add_alias(pj, relation, alias)
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _clear_outer_joins():
+    """ Mappers were reconfigured: join conditions might be stale """
+    _outer_joins.clear()
+
+
+class Explain(Executable, ClauseElement):
+    """ EXPLAIN (FORMAT JSON) a statement, PostgreSQL """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def estimate_rows(query):
+    """ Get the planner's estimate of the number of rows a query returns
+
+    The statement is only planned, not executed.
+
+    :param query: The query, bound to a session
+    :type query: sqlalchemy.orm.Query
+    :rtype: int
+    """
+    plan = query.session.execute(Explain(query.statement)).scalar()
+    if not isinstance(plan, list):  # some drivers don't parse json
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimate_table_rows(session, table):
+    """ Get the number of rows in a table, as seen by the last ANALYZE
+
+    Tables that have never been vacuumed or analyzed have `reltuples` of 0 (PostgreSQL < 14) or -1:
+    an empty table is indistinguishable from a table with no statistics.
+
+    :type session: sqlalchemy.orm.Session
+    :type table: sqlalchemy.Table
+    :return: The number of rows, or None when it's unknown
+    :rtype: int|None
+    """
+    reltuples = session.execute(
+        sql.text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+        {'table': table.fullname}
+    ).scalar()
+    return int(reltuples) if reltuples is not None and reltuples > 0 else None
@@ -24,7 +24,9 @@ setup(
         'sqlalchemy >= 0.9.7',
         'future',
     ],
-    extras_require={},
+    extras_require={
+        'numpy': ['numpy'],
+    },
     include_package_data=True,
     test_suite='nose.collector',
 
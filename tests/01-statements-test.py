@@ -1,16 +1,22 @@
 import unittest
 import re
 import sys
+import threading
 from collections import OrderedDict
 
+from mongosql import MongoModel, MongoQuery
 from mongosql.statements import MongoCriteria
 
-from sqlalchemy.orm import Query
+from sqlalchemy import Column, Integer, Float
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import inspect
+from sqlalchemy.orm import Query, aliased, configure_mappers
 from sqlalchemy.dialects import postgresql as pg
 
 from . import models
 
 MongoCriteria.custom_op('$search', lambda col, value: col.ilike('%{}%'.format(value)))
+MongoCriteria.register_op('$contains', lambda col, value: col.any(value), kinds=('array',))
 
 
 PY2 = sys.version_info[0] == 2
@@ -205,6 +211,10 @@ class StatementsTest(unittest.TestCase):
         # Custom filter
         test_filter({'name': {'$search': 'quer'}}, 'u.name ILIKE %quer%')
 
+        # Custom filter, for some column kinds only
+        test_filter({'tags': {'$contains': 'a'}}, 'a = ANY (u.tags)')
+        self.assertRaises(AssertionError, filter, {'name': {'$contains': 'a'}})
+
     def test_limit(self):
         """ Test limit() """
         m = models.User
@@ -249,8 +259,8 @@ class StatementsTest(unittest.TestCase):
             qs = q2sql(q)
             self.assertIn('SELECT anon_1.a_id AS anon_1_a_id, anon_1.a_title AS anon_1_a_title, anon_1.a_theme AS anon_1_a_theme, u_1.id AS u_1_id, u_1.name AS u_1_name, c_1.id AS c_1_id, c_1.aid AS c_1_aid', qs)
             self.assertIn('FROM (SELECT a.id AS a_id', qs)
-            self.assertIn('a ORDER BY a.theme{} \n LIMIT 2) AS anon_1 LEFT OUTER JOIN c AS c_1 ON anon_1.a_id = c_1.aid JOIN u AS u_1 ON u_1.id = c_1.uid'.format(desc), qs)
-            self.assertTrue(qs.endswith('ORDER BY anon_1.a_theme{}'.format(desc)))
+            self.assertIn('a ORDER BY a.theme{}, a.id \n LIMIT 2) AS anon_1 LEFT OUTER JOIN c AS c_1 ON anon_1.a_id = c_1.aid JOIN u AS u_1 ON u_1.id = c_1.uid'.format(desc), qs)
+            self.assertTrue(qs.endswith('ORDER BY anon_1.a_theme{}, anon_1.a_id'.format(desc)))
         # Three level join
         mq = models.Article.mongoquery(Query([models.Article]))
         mq = mq.query(project=['title'], outerjoin={'comments': {'project': ['aid'],
@@ -302,6 +312,27 @@ class StatementsTest(unittest.TestCase):
                           LIMIT 2) AS anon_1 LEFT OUTER JOIN c AS c_1 ON anon_1.a_id = c_1.aid""",
                        qs)
 
+    def test_join_load(self):
+        """ Test loader strategies of joined relations """
+        def query(**query_obj):
+            return q2sql(models.Article.mongoquery(Query([models.Article])).query(**query_obj).end())
+
+        # Automatic: to-one relations are joined, to-many relations are loaded with a separate SELECT .. IN
+        qs = query(join=['user', 'comments'])
+        self.assertIn('LEFT OUTER JOIN u AS u_1', qs)
+        self.assertNotIn(' c ', qs)
+
+        # Explicit
+        qs = query(join={'user': {'$load': 'selectin'}, 'comments': {'$load': 'joined', 'project': ['text']}})
+        self.assertNotIn(' u ', qs)
+        self.assertIn('c_1.text AS c_1_text', qs)
+        self.assertNotIn('c_1.uid', qs)
+        self.assertIn('LEFT OUTER JOIN c AS c_1', qs)
+
+        # Invalid
+        self.assertRaises(AssertionError, query, join={'comments': {'$load': 'lazy'}})
+        self.assertRaises(AssertionError, query, join={'comments': {'$load': 'selectin', 'filter': {'id': 1}}})
+
     def test_aggregate(self):
         """ Test aggregate() """
         m = models.User
@@ -346,6 +377,14 @@ class StatementsTest(unittest.TestCase):
         self.assertRaises(AssertionError, test_aggregate, {'a': {'$max': '???'}}, '')
         self.assertRaises(AssertionError, test_aggregate, {'a': {'$sum': {'???': 1}}}, '')
 
+        # Having: computed fields are replaced with their expressions; columns are used as is
+        having = lambda having: q2sql(m.mongoquery(Query([m])).query(
+            aggregate=OrderedDict([('age', 'age'), ('n', {'$sum': 1})]), group=['age'], having=having).end())
+        self.assertIn('GROUP BY u.age \nHAVING count(*) > 1', having({'n': {'$gt': 1}}))
+        self.assertIn('HAVING (count(*) = 1 OR u.age >= 18)', having({'$or': [{'n': 1}, {'age': {'$gte': 18}}]}))
+        self.assertRaises(AssertionError, having, {'???': 1})
+        self.assertRaises(AssertionError, m.mongoquery(Query([m])).query, having={'n': 1})  # no aggregate
+
     def test_filter_on_join(self):
         m = models.User
         mq = m.mongoquery(Query([models.User]))
@@ -498,17 +537,198 @@ class StatementsTest(unittest.TestCase):
         self.assertRaises(AssertionError, mq.query, filter={'no_such_property': 1})
         self.assertRaises(AssertionError, mq.query, filter={'calculated': 10})
 
+    def test_column_info(self):
+        """ Test column descriptors cache """
+        bag = models.Article.mongomodel().model_bag
+
+        # Memoized: columns, relation columns, hybrid properties
+        for name in ('title', 'user.name', 'hybrid'):
+            self.assertIs(bag.column_info(name), bag.column_info(name))
+        self.assertEqual(bag.column_info('user.name').kind, 'relation')
+        self.assertEqual(bag.column_info('data').kind, 'json')
+
+        self.assertRaises(AssertionError, bag.column_info, 'no_such_property')
+
+        # Shared descriptors are not modified by type coercion
+        mq = models.Article.mongoquery(Query([models.Article]))
+        qs = q2sql(mq.query(filter={'data': {'$gt': 1, '$lt': 5}}).end())
+        self.assertIn('CAST(a.data AS INTEGER) > 1', qs)
+        self.assertIn('CAST(a.data AS INTEGER) < 5', qs)
+        self.assertIs(bag.column_info('data').sql_col, models.Article.data)
+
+        # JSON paths and their casts are cached
+        self.assertIs(bag.column_info('data.rating'), bag.column_info('data.rating'))
+        self.assertIs(bag.columns['data.rating'], bag.columns['data.rating'])
+        int_type, float_type = Integer(), Float()
+        self.assertIs(bag.columns.coerced('data.rating', int_type), bag.columns.coerced('data.rating', int_type))
+        self.assertIsNot(bag.columns.coerced('data.rating', int_type), bag.columns.coerced('data.rating', float_type))
+
+        # Type coercion of literals reuses types, so the casts are reused as well
+        criteria = lambda value: q2sql(models.Article.mongoquery(Query([models.Article])).query(filter={'data.rating': {'$gte': value}}).end())
+        hits = bag.columns._json_exprs.hits
+        self.assertIn("CAST((a.data #>> ['rating']) AS INTEGER) >= 1", criteria(1))
+        self.assertIn("CAST((a.data #>> ['rating']) AS INTEGER) >= 2", criteria(2))
+        self.assertGreater(bag.columns._json_exprs.hits, hits)
+
     def test_limit_with_filtered_join(self):
         m = models.User
         mq = m.mongoquery(Query([models.User]))
         mq = mq.query(limit=10, join={'articles': {'filter': {'title': {'$exists': True}}}})
         q = mq.end()
         qs = q2sql(q)
-        self._check_qs("""SELECT anon_1.u_id AS anon_1_u_id, anon_1.u_name AS anon_1_u_name, anon_1.u_tags AS anon_1_u_tags, anon_1.u_age AS anon_1_u_age, a_1.id AS a_1_id, a_1.uid AS a_1_uid, a_1.title AS a_1_title, a_1.theme AS a_1_theme, a_1.data AS a_1_data
-FROM (SELECT u.id AS u_id, u.name AS u_name, u.tags AS u_tags, u.age AS u_age
+        # The page of parents is selected by their primary keys
+        self._check_qs("""SELECT u.id AS u_id, u.name AS u_name, u.tags AS u_tags, u.age AS u_age, a_1.id AS a_1_id, a_1.uid AS a_1_uid, a_1.title AS a_1_title, a_1.theme AS a_1_theme, a_1.data AS a_1_data
+FROM u JOIN a AS a_1 ON u.id = a_1.uid
+WHERE u.id IN (SELECT u.id AS u_id
 FROM u
 WHERE EXISTS (SELECT 1
 FROM a
 WHERE u.id = a.uid AND a.title IS NOT NULL)
- LIMIT 10) AS anon_1 JOIN a AS a_1 ON anon_1.u_id = a_1.uid
-WHERE a_1.title IS NOT NULL""", qs)
+ LIMIT 10) AND a_1.title IS NOT NULL""", qs)
+
+        # Sorted: the page is sorted, and so are the parents. The primary key breaks ties
+        mq = m.mongoquery(Query([models.User]))
+        mq = mq.query(sort=['age-'], skip=1, limit=2, join={'articles': {'filter': {'title': {'$exists': True}}}})
+        qs = q2sql(mq.end())
+        self.assertIn('WHERE u.id = a.uid AND a.title IS NOT NULL) ORDER BY u.age DESC, u.id \n LIMIT 2 OFFSET 1)', qs)
+        self.assertTrue(qs.endswith('AND a_1.title IS NOT NULL ORDER BY u.age DESC, u.id'), qs)
+
+    def test_plan_cache(self):
+        """ Test query plan cache """
+        m = models.Article
+        cache = m.mongomodel().plan_cache
+        cache.clear()
+
+        def query(plan_cache=True, **query_obj):
+            mq = MongoQuery(m.mongomodel(), Query([m]), plan_cache=plan_cache)
+            return q2sql(mq.query(**query_obj).end())
+
+        def qo(uid, ids, theme=None):
+            return {'project': ['title'], 'sort': ['id-'], 'filter': {'uid': uid, 'id': {'$in': ids}, 'theme': theme}}
+
+        # Miss: the plan is built
+        qs = query(**qo(1, [10, 11]))
+        self.assertIn('WHERE (a.uid = 1 AND a.id IN (10, 11) AND a.theme IS NULL) ORDER BY a.id DESC', qs)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'size': 1, 'maxsize': m.mongomodel().plan_cache.maxsize})
+
+        # Hit: same shape, new values are bound
+        qs = query(**qo(2, [20, 21]))
+        self.assertIn('WHERE (a.uid = 2 AND a.id IN (20, 21) AND a.theme IS NULL) ORDER BY a.id DESC', qs)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Different shapes: list length, value types, None are a part of the shape
+        self.assertIn('a.id IN (20, 21, 22)', query(**qo(2, [20, 21, 22])))
+        self.assertIn('a.uid = 2', query(**qo(2, [20, 21], theme='x')))
+        self.assertIn('a.uid = 2', query(**qo('2', [20, 21])))
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+        # JSON columns are coerced by the value type
+        self.assertIn("CAST((a.data #>> ['rating']) AS FLOAT) >= 5.5", query(filter={'data.rating': {'$gte': 5.5}}))
+        self.assertIn("CAST((a.data #>> ['rating']) AS FLOAT) >= 4.5", query(filter={'data.rating': {'$gte': 4.5}}))
+
+        # Disabled
+        query(plan_cache=False, **qo(3, [30]))
+        self.assertEqual((cache.hits, cache.misses), (2, 5))
+
+        # Parent and joined queries bind their own parameters
+        m = models.Comment
+        qs = q2sql(m.mongoquery(Query([m])).query(filter={'id': 1}, join={'article': {'filter': {'id': 2}}}).end())
+        self.assertIn('c.id = 1', qs)
+        self.assertIn('a_1.id = 2', qs)
+
+    def test_registry(self):
+        """ Test MongoModel registry """
+        # One per model
+        self.assertIs(MongoModel.get_for(models.User), models.User.mongomodel())
+        self.assertIs(MongoModel.get_for(models.User), MongoModel.get_for(models.User))
+        self.assertIsNot(MongoModel.get_for(models.User), MongoModel.get_for(models.Article))
+
+        # Aliases get their own
+        self.assertIsNot(MongoModel.get_for(aliased(models.User)), MongoModel.get_for(models.User))
+
+        # Warm-up
+        ret = MongoModel.warm_up(models.Base)
+        self.assertEqual(ret['models'], len(models.Base._decl_class_registry) - 1)  # minus the module marker
+        self.assertIn(inspect(models.Comment), MongoModel._registry)
+
+        # Concurrent first access
+        user_mongomodel = MongoModel._registry.pop(inspect(models.User))
+        try:
+            start = threading.Event()
+            got = []
+
+            def get():
+                start.wait()
+                got.append(MongoModel.get_for(models.User))
+
+            threads = [threading.Thread(target=get) for _ in range(8)]
+            for t in threads:
+                t.start()
+            start.set()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(got), 8)
+            self.assertEqual(len(set(map(id, got))), 1)
+        finally:
+            MongoModel._registry[inspect(models.User)] = user_mongomodel
+
+    def test_aliased_bags(self):
+        """ Test property bags of aliases """
+        bag = MongoModel.get_for(models.Article).model_bag
+        alias = aliased(models.Article)
+        alias_bag = MongoModel.get_for(alias).model_bag
+
+        # Derived from the model's bags
+        self.assertIs(alias_bag.model, alias)
+        self.assertIs(alias_bag.columns.names, bag.columns.names)
+        self.assertEqual(set(alias_bag.relations.names), set(bag.relations.names))
+        self.assertTrue(alias_bag.columns.is_column_json('data.rating'))
+
+        # Properties of the alias
+        self.assertIs(alias_bag.columns['title'], alias.title)
+        self.assertIs(alias_bag.relations['user'], alias.user)
+        self.assertEqual(dict(alias_bag.pk.items()), {'id': alias.id})
+        self.assertRaises(AssertionError, alias_bag.columns.__getitem__, 'no_such_column')
+        self.assertEqual(alias_bag.column_info('title').sql_col, alias.title)
+
+        # The model's bags are unchanged
+        self.assertIs(bag.columns['title'], models.Article.title)
+        self.assertIs(bag.column_info('title').sql_col, models.Article.title)
+
+    def test_alias_cache(self):
+        """ Test reusing aliases of joined relations """
+        m = models.User
+        join = lambda join_func, query_obj: m.mongoquery(Query([m])).query(**{join_func: query_obj})
+        alias = lambda mq: mq.join_queries[0].mjp.rel_alias
+
+        # Same relationship path and join type: same alias
+        a1 = alias(join('join', {'articles': {'filter': {'id': 1}}}))
+        a2 = alias(join('join', {'articles': {'filter': {'id': 2}}}))
+        self.assertIs(a1, a2)
+        self.assertIs(MongoModel.get_for(a1), MongoModel.get_for(a2))
+
+        # Different join type, different path: different alias
+        self.assertIsNot(alias(join('outerjoin', {'articles': {'filter': {'id': 1}}})), a1)
+        nested = join('join', {'comments': {'join': {'user': {'join': {'articles': {}}}}}})
+        nested.end()
+        self.assertIsNot(alias(nested.join_queries[0].query.join_queries[0].query), a1)
+
+        # Same nested path under a join and an outer join: different aliases
+        nested_join = join('join', {'comments': {'join': {'user': {}}}})
+        nested_outer = join('outerjoin', {'comments': {'join': {'user': {}}}})
+        nested_join.end()
+        nested_outer.end()
+        self.assertIsNot(alias(nested_join.join_queries[0].query), alias(nested_outer.join_queries[0].query))
+
+        # Outer joins with a filter reuse join conditions
+        qs1 = q2sql(join('outerjoin', {'articles': {'filter': {'id': 1}}}).end())
+        qs2 = q2sql(join('outerjoin', {'articles': {'filter': {'id': 2}}}).end())
+        self.assertIn('LEFT OUTER JOIN a AS a_1 ON u.id = a_1.uid AND a_1.id = 1', qs1)
+        self.assertIn('LEFT OUTER JOIN a AS a_1 ON u.id = a_1.uid AND a_1.id = 2', qs2)
+
+        # Reconfiguring mappers drops the aliases
+        class Tmp(declarative_base()):
+            __tablename__ = 'tmp'
+            id = Column(Integer, primary_key=True)
+        configure_mappers()
+        self.assertIsNot(alias(join('join', {'articles': {'filter': {'id': 1}}})), a1)
@@ -1,5 +1,8 @@
 import unittest
-from sqlalchemy import inspect
+from sqlalchemy import inspect, event
+
+from mongosql import CrudHelper, StrictCrudHelper, MongoQuery
+from mongosql.batch import MongoBatch
 
 from . import models
 
@@ -132,6 +135,23 @@ class QueryTest(unittest.TestCase):
         comment = article.comments[0]
         self.assertEqual(inspect(comment).unloaded, {'uid', 'aid', 'user', 'article'})  # Only fields specified in the 'project' are loaded
 
+    def test_join_load(self):
+        """ Test loading relations with selectin """
+        ssn = self.db
+        statements = []
+        listener = lambda conn, cursor, statement, *a: statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+
+        mq = models.Article.mongoquery(ssn.query(models.Article)).query(
+            sort=['id+'], limit=2, join={'comments': {'$load': 'selectin', 'project': ['text']}})
+        articles = mq.end().all()
+        self.assertEqual([(a.id, len(a.comments)) for a in articles], [(10, 3), (11, 2)])
+        self.assertEqual(len(statements), 2)  # articles, then comments IN (...)
+        self.assertIn('LIMIT', statements[0])
+        self.assertNotIn('JOIN', statements[0])
+        self.assertEqual(mq.get_project()['comments'], {'text': 1})
+
     def test_count(self):
         """ Test count() """
         ssn = self.db
@@ -140,6 +160,75 @@ class QueryTest(unittest.TestCase):
         n = models.User.mongoquery(ssn).count().end().scalar()
         self.assertEqual(3, n)
 
+        def count(query_obj, query=None):
+            q = models.Article.mongoquery(query or ssn.query(models.Article)).query(count=1, **query_obj).end()
+            return str(q), q.scalar()
+
+        # Projection, sorting and joins are dropped; relation filters remain
+        qs, n = count({'project': ['title'], 'sort': ['id-'], 'filter': {'uid': 1},
+                       'join': {'comments': {'filter': {'uid': 2}}}})
+        self.assertEqual(n, 2)
+        self.assertTrue(qs.startswith('SELECT count(*) AS count_1 \nFROM a \nWHERE a.uid = '), qs)
+        self.assertIn('EXISTS (SELECT 1', qs)
+
+        # Joins of the initial query: distinct primary keys
+        qs, n = count({}, ssn.query(models.Article).join(models.Article.comments))
+        self.assertEqual(n, 5)
+        self.assertIn('count(DISTINCT a.id)', qs)
+
+        # Grouping: a subquery
+        qs, n = count({'group': ['uid']})
+        self.assertEqual(n, 3)
+        self.assertIn('FROM (SELECT a.uid AS a_uid \nFROM a GROUP BY a.uid)', qs)
+        qs, n = count({'limit': 2})
+        self.assertEqual(n, 2)
+
+        # Aggregation: aggregated rows are counted
+        qs, n = count({'aggregate': {'n': {'$sum': 1}}})
+        self.assertEqual(n, 1)
+        qs, n = count({'aggregate': {'n': {'$sum': 1}}, 'group': ['uid']})
+        self.assertEqual(n, 3)
+
+        # Estimate
+        estimate = lambda query_obj, **kw: models.Article.mongoquery(ssn.query(models.Article)) \
+            .query(count='estimate', **query_obj).estimate_count(**kw)
+        self.assertEqual(estimate({}), 6)  # small numbers are counted exactly
+        self.assertEqual(estimate({'filter': {'uid': 1}}), 3)
+        self.assertIsInstance(estimate({'filter': {'uid': 1}}, exact_below=0), int)  # EXPLAIN
+        self.assertEqual(estimate({}, exact_below=0), 6)  # never analyzed: no pg_class.reltuples
+        ssn.execute('ANALYZE a')
+        self.assertEqual(estimate({}, exact_below=0), 6)  # pg_class.reltuples
+
+        # Page with the total: joined rows are not counted
+        rows = models.Article.mongoquery(ssn.query(models.Article)).query(
+            with_total=1, sort=['id+'], limit=2, join={'comments': {'filter': {'id': {'$gt': 0}}}}).end().all()
+        self.assertEqual([(a.id, total) for a, total in rows], [(10, 5), (11, 5)])
+
+    def test_rows(self):
+        """ Test rows() """
+        ssn = self.db
+        mq = lambda **query_obj: models.Article.mongoquery(ssn.query(models.Article)).query(rows=1, **query_obj)
+
+        # Columns of the projection, no instances
+        rows = mq(project=['id', 'title'], sort=['id-'], limit=2).end().all()
+        self.assertEqual([tuple(row) for row in rows], [(30, '30'), (21, '21')])
+        self.assertEqual(rows[0].keys(), ['id', 'title'])
+        self.assertEqual(len(ssn.identity_map), 0)
+
+        # All columns; exclusion
+        self.assertEqual(mq(filter={'id': 10}).end().one().keys(), ['id', 'uid', 'title', 'theme', 'data'])
+        self.assertEqual(mq(filter={'id': 10}, project={'data': 0}).end().one().keys(), ['id', 'uid', 'title', 'theme'])
+
+        # Keyset pagination goes backwards
+        cursor = mq(project=['id'], sort=['id-']).cursor(ssn.query(models.Article).get(12))
+        self.assertEqual(mq(project=['id'], sort=['id-'], limit=2, before=cursor).end().all(), [(21,), (20,)])
+
+        # Only columns
+        with self.assertRaises(AssertionError):
+            mq(project=['calculated']).end()
+        with self.assertRaises(AssertionError):
+            mq(join=['comments'])
+
     def test_aggregate(self):
         """ Test aggregate() """
         ssn = self.db
@@ -169,6 +258,10 @@ class QueryTest(unittest.TestCase):
         rows = models.User.mongoquery(ssn).aggregate(q).group(['age']).sort(['age-']).end().all()
         self.assertEqual([row2dict(r) for r in rows], [{'age': 18, 'n': 2}, {'age': 16, 'n': 1}])
 
+        # Test: having
+        rows = models.User.mongoquery(ssn).query(aggregate=q, group=['age'], having={'n': {'$gt': 1}}).end().all()
+        self.assertEqual([row2dict(r) for r in rows], [{'age': 18, 'n': 2}])
+
     def test_json(self):
         """ Test operations on a JSON column """
         ssn = self.db
@@ -203,3 +296,131 @@ class QueryTest(unittest.TestCase):
         self.assertEqual(row2dict(row), {'high': 3, 'max_rating': 6, 'a_is_none': 2})
 
         # Aggregate & Group
+
+    def test_baked(self):
+        """ Test baked queries """
+        ssn = self.db
+        helper = CrudHelper(models.Article, bakery_size=10)
+
+        def query(query_obj, **filter_by):
+            mq = helper.mquery(ssn.query(models.Article), query_obj, filter_by)
+            return mq.end().all(), mq.get_project()
+
+        # Same shape, different values
+        qo = lambda uid: {'project': ['title'], 'filter': {'uid': uid}, 'sort': ['id+']}
+        rows, projection = query(qo(1))
+        self.assertEqual([a.id for a in rows], [10, 11, 12])
+        self.assertEqual(projection, {'title': 1})
+        rows, projection = query(qo(2))
+        self.assertEqual([a.id for a in rows], [20, 21])
+        self.assertEqual(helper.bakery.stats()['hits'], 1)
+        self.assertEqual(helper.bakery.stats()['misses'], 1)
+
+        # Joined filters and filter_by() are bound as well
+        qo = lambda cid: {'project': ['id'], 'join': {'comments': {'filter': {'id': cid}}}}
+        for id, cid in ((10, 100), (20, 107)):
+            ssn.close()
+            rows, projection = query(qo(cid), id=id)
+            self.assertEqual([a.id for a in rows], [id])
+            self.assertEqual([c.id for c in rows[0].comments], [cid])
+        self.assertEqual(helper.bakery.stats()['hits'], 2)
+
+        # Count
+        for uid, n in ((1, 3), (3, 1)):
+            rows, _ = query({'filter': {'uid': uid}, 'count': 1})
+            self.assertEqual(rows[0][0], n)
+
+        # Queries with criteria are not baked
+        mq = helper.mquery(ssn.query(models.Article).filter_by(uid=1), {})
+        self.assertIsInstance(mq, MongoQuery)
+
+    def test_keyset(self):
+        """ Test keyset pagination """
+        ssn = self.db
+        helper = StrictCrudHelper(models.Article, allow_relations=('comments',), max_skip=2)
+
+        def page(**query_obj):
+            rows = helper.mquery(ssn.query(models.Article), query_obj).end().all()
+            return [(a.uid, a.id) for a in rows], rows
+
+        # Sort is completed with the primary key
+        ids, rows = page(sort=['uid-'], limit=2)
+        self.assertEqual(ids, [(3, 30), (2, 20)])
+
+        # Next page
+        ids, rows = page(sort=['uid-'], limit=2, after=helper.cursor(rows[-1], {'sort': ['uid-']}))
+        self.assertEqual(ids, [(2, 21), (1, 10)])
+
+        # Previous page: still in the right order
+        ids, _ = page(sort=['uid-'], limit=2, before=helper.cursor(rows[0], {'sort': ['uid-']}))
+        self.assertEqual(ids, [(3, 30), (2, 20)])
+
+        # Duplicate sort values: the first page is ordered like the pages after it, and every row comes once
+        all_ids, cursor = [], None
+        for i in range(3):
+            ids, rows = page(sort=['uid+'], limit=2, after=cursor)
+            all_ids.extend(ids)
+            cursor = helper.cursor(rows[-1], {'sort': ['uid+']})
+        self.assertEqual(all_ids, [(1, 10), (1, 11), (1, 12), (2, 20), (2, 21), (3, 30)])
+        self.assertIn('ORDER BY a.uid, a.id', str(helper.mquery(ssn.query(models.Article), {'sort': ['uid+'], 'limit': 2}).end()))
+
+        # No sort: primary key
+        ids, _ = page(limit=2, after=helper.cursor(ssn.query(models.Article).get(11)))
+        self.assertEqual(ids, [(1, 12), (2, 20)])
+
+        # Joins
+        cursor = helper.cursor(ssn.query(models.Article).get(20), {'sort': ['uid-']})
+        ids, rows = page(sort=['uid-'], limit=2, after=cursor, join={'comments': {'filter': {'id': {'$gt': 0}}}})
+        self.assertEqual(ids, [(2, 21), (1, 10)])
+        self.assertEqual([len(a.comments) for a in rows], [1, 3])
+
+        cursor = helper.cursor(ssn.query(models.Article).get(10), {'sort': ['uid-']})
+        ids, rows = page(sort=['uid-'], limit=2, before=cursor, join={'comments': {'filter': {'id': {'$gt': 0}}}})
+        self.assertEqual(ids, [(2, 20), (2, 21)])
+        self.assertEqual([len(a.comments) for a in rows], [2, 1])
+
+        # Cursor does not match the sort
+        with self.assertRaises(AssertionError):
+            page(sort=['title'], after=cursor)
+        with self.assertRaises(AssertionError):
+            page(sort=['uid-'], after='garbage')
+
+        # Deep skip is not allowed
+        page(skip=2)
+        with self.assertRaises(AssertionError):
+            page(skip=3)
+
+    def test_batch(self):
+        """ Test batch execution of Query Objects """
+        ssn = self.db
+        helper = CrudHelper(models.Article)
+
+        statements = []
+        listener = lambda conn, cursor, statement, *a: statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+
+        batch = MongoBatch(ssn)
+        batch.add(models.Article, {'count': 1})
+        batch.add(models.User, {'filter': {'age': 18}, 'project': ['id'], 'sort': ['id+']})
+        batch.add(helper, {'filter': {'uid': 1}, 'count': 1})
+        batch.add(helper, {'filter': {'uid': 2}, 'count': 1})  # same shape, another value
+        batch.add(models.User, {'count': 1})
+        batch.add(models.Article, {'aggregate': {'n': {'$sum': 1}}, 'group': ['uid'], 'sort': ['uid+']})
+        results = batch.execute()
+
+        self.assertEqual([r for r, _ in results[:1] + results[2:5]], [6, 3, 2, 3])
+        users, projection = results[1]
+        self.assertEqual([u.id for u in users], [1, 2])
+        self.assertEqual(projection, {'id': 1})
+        self.assertEqual(results[5], ([{'n': 3}, {'n': 2}, {'n': 1}], None))
+
+        # Article counts: a single statement; the User count is not merged
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(sum('FILTER (WHERE' in s for s in statements), 1)
+
+        # Results are the same as CrudViewMixin gives: an empty page past the end still has the total
+        batch = MongoBatch(ssn)
+        batch.add(helper, {'filter': {'uid': 1}, 'skip': 10, 'with_total': 1})
+        (page, total), _ = batch.execute()[0]
+        self.assertEqual((page, total), ([], 3))
@@ -1,9 +1,22 @@
+import gzip
+import io
+import json
+import sys
 import unittest
 
 from flask import Flask, g
 from flask_jsontools import FlaskJsonClient, DynamicJSONEncoder
+from sqlalchemy import event, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Query
 from sqlalchemy.orm.exc import NoResultFound
 
+from mongosql import CrudHelper, StrictCrudHelper
+from mongosql.capture import QueryCapture
+from mongosql.crud import _fetch, _row_columns
+from mongosql.export import QueryExport
+from mongosql.resultcache import ResultCache, DictCacheBackend
+from mongosql.serializer import Serializer
 from . import models
 from .crud_view import ArticlesView
 
@@ -105,6 +118,136 @@ class CrudTest(unittest.TestCase):
                 }})
             self.assertEqual(rv['articles'], 6)  # `maxitems` shouldnt apply here
 
+        # Test page with the total
+        with self.app.test_client() as c:
+            rv = c.get('/article/', json={
+                'query': {
+                    'filter': {'uid': 1},
+                    'project': ['id'],
+                    'with_total': 1,
+                }})
+            self.assertEqual(rv['articles'], [{'id': 12}, {'id': 11}])  # `maxitems` applies
+            self.assertEqual(rv['total'], 3)
+
+            # Past the last page
+            rv = c.get('/article/', json={
+                'query': {
+                    'filter': {'uid': 1},
+                    'skip': 10,
+                    'with_total': 1,
+                }})
+            self.assertEqual(rv['articles'], [])
+            self.assertEqual(rv['total'], 3)
+
+        # Test rows: dicts of the columns, no instances
+        with self.app.test_client() as c:
+            rv = c.get('/article/', json={
+                'query': {
+                    'filter': {'uid': 1},
+                    'project': ['id', 'title'],
+                    'rows': 1,
+                }})
+            self.assertEqual(rv['articles'], [{'id': 12, 'title': '12'}, {'id': 11, 'title': '11'}])
+
+            rv = c.get('/article/', json={
+                'query': {
+                    'filter': {'uid': 1},
+                    'project': ['id'],
+                    'rows': 1,
+                    'with_total': 1,
+                }})
+            self.assertEqual(rv['articles'], [{'id': 12}, {'id': 11}])
+            self.assertEqual(rv['total'], 3)
+
+        # Test columnar: a dict of columns
+        with self.app.test_client() as c:
+            rv = c.get('/article/', json={
+                'query': {
+                    'aggregate': {'uid': 'uid', 'n': {'$sum': 1}},
+                    'group': ['uid'],
+                    'sort': ['uid+'],
+                    'columnar': 1,
+                }})
+            self.assertEqual(rv['articles'], {'uid': [1, 2, 3], 'n': [3, 2, 1]})
+
+            rv = c.get('/article/', json={
+                'query': {
+                    'filter': {'uid': 1},
+                    'project': ['id', 'title'],
+                    'rows': 1,
+                    'with_total': 1,
+                    'columnar': 1,
+                }})
+            self.assertEqual(rv['articles'], {'id': [12, 11], 'title': ['12', '11']})
+            self.assertEqual(rv['total'], 3)
+
+        # Test page with the total and a cursor: the total is the number of rows past the cursor
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+            query_obj = {'filter': {'uid': 1}, 'sort': ['id+'], 'limit': 1, 'with_total': 1}
+            cursor = lambda id: view._getCrudHelper().cursor(self.db.query(models.Article).get(id), query_obj)
+
+            (rows, total), _ = view._method_list(dict(query_obj, after=cursor(10)))
+            self.assertEqual(([a.id for a in rows], total), ([11], 2))
+            (rows, total), _ = view._method_list(dict(query_obj, after=cursor(12)))  # empty page: counted separately
+            self.assertEqual((rows, total), ([], 0))
+            (rows, total), _ = view._method_list(dict(query_obj, before=cursor(10)))
+            self.assertEqual((rows, total), ([], 0))
+
+        # Test page with the total and `count_estimate`: the total of an empty page is exact, like of any other page
+        class EstimatingView(ArticlesView):
+            crudhelper = StrictCrudHelper(models.Article, count_estimate=0)
+
+        with self.app.test_request_context():
+            g.db = self.db
+            view = EstimatingView()
+            self.db.execute('ANALYZE a')
+            self.db.add(models.Article(id=40, uid=3, title='40'))
+            self.db.flush()  # statistics are stale now
+
+            self.assertEqual(view._method_list({'count': 1}), (6, None))  # estimated
+            self.assertEqual(view._method_list({'skip': 10, 'with_total': 1})[0], ([], 7))
+
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+
+            # No rows: still has the columns
+            columns, _ = view._method_list({'filter': {'uid': 999}, 'project': ['id'], 'rows': 1, 'columnar': 1})
+            self.assertEqual(columns, {'id': []})
+
+            # Read straight from the cursor: no Query.all()
+            query_obj = {'filter': {'uid': 1}, 'project': ['id', 'title'], 'rows': 1, 'columnar': 1}
+            all, Query.all = Query.all, lambda query: self.fail('Query.all() loaded the rows')
+            try:
+                columns, _ = view._method_list(query_obj)
+            finally:
+                Query.all = all
+            self.assertEqual(columns, {'id': [12, 11], 'title': ['12', '11']})  # `maxitems` applies
+
+            # Baked queries are loaded as rows
+            helper = CrudHelper(models.Article, bakery_size=10)
+            for uid, ids in ((1, [10, 11, 12]), (2, [20, 21])):
+                sql_query = helper.mquery(self.db.query(models.Article), dict(query_obj, filter={'uid': uid}, sort=['id+'])).end()
+                self.assertEqual(_row_columns(_fetch(sql_query, query_obj))['id'], ids)
+            self.assertEqual(helper.bakery.stats()['hits'], 1)
+
+            # NumPy, when installed
+            query_obj = {'aggregate': {'n': {'$sum': 1}}, 'sort': None, 'columnar': 'numpy'}
+            try:
+                import numpy
+            except ImportError:
+                self.assertRaises(AssertionError, view._method_list, query_obj)
+            else:
+                columns, _ = view._method_list(query_obj)
+                self.assertIsInstance(columns['n'], numpy.ndarray)
+                self.assertEqual(columns['n'].tolist(), [6])
+
+            # Only aggregates and rows
+            with self.assertRaises(AssertionError):
+                view._method_list({'columnar': 1})
+
     def test_create(self):
         """ Test create() """
 
@@ -284,3 +427,293 @@ class CrudTest(unittest.TestCase):
                 assert False, 'Should throw an exception'
             except:
                 pass
+
+    def test_query_capture(self):
+        """ Test capturing SQL statements """
+        with self.app.test_client() as c:
+            # Disabled by default
+            c.get('/article/30')
+            self.assertEqual(ArticlesView().sqlaclhemy_queries, [])
+
+            # Enabled
+            ArticlesView.query_capture = capture = QueryCapture(enabled=True, size=2)
+            try:
+                c.get('/article/30')
+                c.get('/article/30')  # same query: rendered from cache
+                c.get('/article/', json={'query': {'filter': {'uid': 3}}})
+
+                # Ring buffer
+                self.assertEqual(len(capture), 2)
+                get_sql, list_sql = ArticlesView().sqlaclhemy_queries
+                self.assertIn('WHERE a.id = 30', get_sql)
+                self.assertIn('WHERE a.uid = 3', list_sql)
+                self.assertEqual(capture.render_cache.stats()['hits'], 1)
+
+                # Timings
+                for captured in capture:
+                    self.assertGreater(captured.build_time, 0)
+                    self.assertGreater(captured.execute_time, 0)
+
+                # Sampling
+                capture.clear()
+                capture.enabled = False
+                c.get('/article/30')
+                self.assertEqual(len(capture), 0)
+
+                capture.sample_rate = 1.0
+                c.get('/article/30')
+                self.assertEqual(len(capture), 1)
+            finally:
+                ArticlesView.query_capture = None
+
+    def test_list_stream(self):
+        """ Test streaming the list in chunks """
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+            view.stream_chunk_size = 1
+
+            # Chunks; `maxitems` still applies
+            chunks, projection = view._method_list_stream({'project': ['id'], 'sort': ['id+']})
+            self.assertEqual(projection, {'id': 1})
+            first = next(chunks)
+            self.assertEqual([a.id for a in first], [10])
+            self.assertIn(first[0], self.db)
+
+            # Consumed chunks are expunged
+            self.assertEqual([[a.id for a in chunk] for chunk in chunks], [[11]])
+            self.assertNotIn(first[0], self.db)
+
+    def test_serializer(self):
+        """ Test the compiled serializer """
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+            serializer = view.serializer = Serializer(dumps=lambda value: json.dumps(value, sort_keys=True))
+
+            # Nested relations: lists and objects
+            articles, projection = view._method_list({'project': ['id', 'uid', 'calculated'], 'sort': ['id+'],
+                                                      'join': {'user': {'project': ['name']}, 'comments': {'project': ['id']}}})
+            self.assertEqual(view._serialize(articles, projection), [
+                {'id': 10, 'uid': 1, 'calculated': 3, 'user': {'name': 'a'}, 'comments': [{'id': 100}, {'id': 101}, {'id': 102}]},
+                {'id': 11, 'uid': 1, 'calculated': 3, 'user': {'name': 'a'}, 'comments': [{'id': 103}, {'id': 104}]},
+            ])
+
+            # Compiled once per (model, projection)
+            self.assertIs(serializer.compile(models.Article, projection), serializer.compile(models.Article, projection))
+            self.assertEqual(serializer._compiled.stats()['size'], 3)  # article, user, comment
+
+            # JSON encoder hook; missing relations
+            article = models.Article(id=1, title='x')
+            self.assertEqual(serializer.to_json(models.Article, {'id': 1, 'title': 1, 'user': {'id': 1}}, article),
+                             '{"id": 1, "title": "x", "user": null}')
+
+            # Not a relationship
+            with self.assertRaises(AssertionError):
+                serializer.compile(models.Article, {'title': {'id': 1}})
+
+    def test_export(self):
+        """ Test exporting the list """
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+            query_obj = {'project': ['id', 'uid', 'data'], 'sort': ['id+'], 'join': {'user': {'project': ['name']}}}
+
+            # NDJSON
+            sink = io.BytesIO()
+            self.assertEqual(view._method_export(sink, QueryExport('ndjson'), query_obj), 2)  # `maxitems`
+            rows = [json.loads(line) for line in sink.getvalue().decode('utf-8').splitlines()]
+            self.assertEqual(rows[0], {'id': 10, 'uid': 1, 'data': {'rating': 5, 'o': {'a': True}}, 'user': {'name': 'a'}})
+            self.assertEqual(rows[1]['id'], 11)
+
+            # CSV, gzipped, small buffer
+            sink = io.BytesIO()
+            view._method_export(sink, QueryExport('csv', compress=True, buffer_size=10), query_obj)
+            lines = gzip.GzipFile(fileobj=io.BytesIO(sink.getvalue())).read().decode('utf-8').splitlines()
+            self.assertEqual(lines, [
+                'id,uid,data,user',
+                '10,1,"{""rating"":5,""o"":{""a"":true}}","{""name"":""a""}"',
+                '11,1,"{""rating"":5.5,""o"":{""a"":true}}","{""name"":""a""}"',
+            ])
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio')
+    def test_async(self):
+        """ Test the coroutine variants of the CRUD methods """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from mongosql.aio import AsyncCrudViewMixin
+
+        class AsyncArticlesView(AsyncCrudViewMixin, ArticlesView):
+            executor = ThreadPoolExecutor(1)
+
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+        try:
+            with self.app.test_request_context():
+                g.db = self.db
+                view = AsyncArticlesView()
+
+                # List: same results as the sync method
+                qo = {'filter': {'uid': 1}, 'project': ['id']}
+                self.assertEqual(run(view._method_list_async(dict(qo))), view._method_list(dict(qo)))
+                self.assertEqual(run(view._method_list_async({'count': 1})), (6, None))
+
+                # Concurrent coroutines on the same view: every one gets its own results
+                tasks = [loop.create_task(view._method_list_async(dict(qo))), loop.create_task(view._method_list_async({'count': 1}))]
+                run(asyncio.wait(tasks))
+                self.assertEqual([t.result() for t in tasks], [view._method_list(dict(qo)), (6, None)])
+
+                # List: served from the result cache, like the sync method
+                cache = AsyncArticlesView.result_cache = ResultCache(sessions=self.Session)
+                self.addCleanup(cache.close)
+                self.assertEqual(run(view._method_list_async({'count': 1})), (6, None))
+                self.assertEqual(run(view._method_list_async({'count': 1})), (6, None))
+                self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+                AsyncArticlesView.result_cache = None
+
+                # Get
+                article, projection = run(view._method_get_async(None, id=10))
+                self.assertEqual(article.id, 10)
+                with self.assertRaises(NoResultFound):
+                    run(view._method_get_async(None, id=999))
+
+                # Create, update, delete
+                article = run(view._method_create_async({'title': 'new'}))
+                self.assertEqual(article.title, 'new')
+                article = run(view._method_update_async({'title': 'updated', 'data': {'x': 1}}, id=10))
+                self.assertEqual((article.title, article.data['x'], article.data['rating']), ('updated', 1, 5))
+                article = run(view._method_delete_async(id=11))
+                self.assertEqual(article.id, 11)
+        finally:
+            loop.close()
+            AsyncArticlesView.executor.shutdown()
+
+    def test_get_many(self):
+        """ Test fetching entities by primary keys """
+        with self.app.test_request_context():
+            g.db = self.db
+            view = ArticlesView()
+            view.get_many_chunk_size = 10  # capped by `maxitems`: 2 per query
+
+            statements = []
+            listener = lambda conn, cursor, statement, *a: statements.append(statement)
+            event.listen(self.engine, 'before_cursor_execute', listener)
+            self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+
+            # Input order, missing keys
+            (articles, missing), projection = view._method_get_many([30, 999, 10, 11, 30], {'project': ['id', 'title']})
+            self.assertEqual([a.id for a in articles], [30, 10, 11, 30])
+            self.assertEqual(missing, [999])
+            self.assertEqual(projection, {'id': 1, 'title': 1})
+            self.assertEqual(len(statements), 2)  # chunks of 2: [30, 999], [10, 11]
+
+            # Identity map hits don't touch the database
+            del statements[:]
+            (articles, missing), _ = view._method_get_many([11, 10], {'project': ['title']})
+            self.assertEqual([a.id for a in articles], [11, 10])
+            self.assertEqual(statements, [])
+
+            # Unless they miss columns of the projection
+            (articles, missing), _ = view._method_get_many([11, 10])
+            self.assertEqual([a.id for a in articles], [11, 10])
+            self.assertEqual(len(statements), 1)
+            del statements[:]
+            (articles, missing), _ = view._method_get_many([11, 10])
+            self.assertEqual(statements, [])
+            del statements[:]
+
+            # Unless they could be filtered out
+            (articles, missing), _ = view._method_get_many([11, 10], {'filter': {'id': {'$gt': 10}}})
+            self.assertEqual(([a.id for a in articles], missing), ([11], [10]))
+            self.assertEqual(len(statements), 1)
+
+        # Composite keys
+        class Tag(declarative_base()):
+            __tablename__ = 'tags'
+            aid = Column(Integer, primary_key=True)
+            name = Column(String, primary_key=True)
+
+        helper = CrudHelper(Tag)
+        self.assertEqual(str(helper.pk_criterion([(1, 'a'), [2, 'b']])),
+                         '(tags.aid, tags.name) IN ((:param_1, :param_2), (:param_3, :param_4))')
+        self.assertEqual(helper.pk_of(Tag(aid=1, name='a')), (1, 'a'))
+
+    def test_result_cache(self):
+        """ Test caching the list results """
+        cache = ResultCache(sessions=self.Session)
+        self.addCleanup(cache.close)
+        statements = []
+        listener = lambda conn, cursor, statement, *a: statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+
+        ArticlesView.result_cache = cache
+        try:
+            with self.app.test_request_context():
+                g.db = self.db
+                view = ArticlesView()
+                qo = {'sort': ['id+'], 'filter': {'uid': 1}, 'join': ['comments']}
+
+                # Miss, then hit: no query
+                articles, projection = view._method_list(qo)
+                n = len(statements)  # articles, comments
+                cached, cached_projection = view._method_list({'join': ['comments'], 'filter': {'uid': 1}, 'sort': ['id+']})
+                self.assertEqual(cached_projection, projection)
+                self.assertEqual([(a.id, len(a.comments)) for a in cached], [(10, 3), (11, 2)])
+                self.assertEqual(len(statements), n)  # relations are cached as well
+                self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+                # Counts
+                self.assertEqual(view._method_list({'filter': {'uid': 1}, 'count': 1}), (3, None))
+                self.assertEqual(view._method_list({'filter': {'uid': 1}, 'count': 1}), (3, None))
+                self.assertEqual(len(statements), n + 1)
+
+                # Extra criteria are a part of the key
+                self.assertEqual(view._method_list({'filter': {'id': {'$gt': 0}}, 'count': 1}, models.Article.uid == 2), (2, None))
+                self.assertEqual(view._method_list({'filter': {'id': {'$gt': 0}}, 'count': 1}, uid=3), (1, None))
+                self.assertEqual(len(statements), n + 3)
+
+            # Cached instances are merged into another session
+            ssn = self.Session()
+            self.addCleanup(ssn.close)
+            with self.app.test_request_context():
+                g.db = ssn
+                cached, _ = ArticlesView()._method_list(qo)
+                self.assertTrue(all(a in ssn for a in cached))
+                self.assertNotIn(cached[0], self.db)
+            self.assertEqual(len(statements), n + 3)
+
+            # A commit invalidates the results of the changed tables only
+            ssn.begin()
+            ssn.query(models.Comment).get(100).text = 'changed'
+            ssn.commit()
+            del statements[:]
+            with self.app.test_request_context():
+                g.db = self.db
+                view = ArticlesView()
+                view._method_list({'filter': {'uid': 1}, 'count': 1})
+                self.assertEqual(statements, [])
+                view._method_list(qo)
+                self.assertEqual(len(statements), n)
+
+            # Uncommitted changes are not cached, and a rollback invalidates what the session has seen
+            ssn.begin()
+            ssn.query(models.Article).get(10).title = 'uncommitted'
+            with self.app.test_request_context():
+                g.db = ssn
+                articles, _ = ArticlesView()._method_list(qo)
+                self.assertEqual(articles[0].title, 'uncommitted')
+            ssn.rollback()
+            with self.app.test_request_context():
+                g.db = other = self.Session()
+                self.addCleanup(other.close)
+                articles, _ = ArticlesView()._method_list(qo)
+                self.assertEqual(articles[0].title, '10')
+        finally:
+            ArticlesView.result_cache = None
+
+        # TTL
+        backend = DictCacheBackend()
+        backend.set('a', 1, ttl=60)
+        backend.set('b', 2, ttl=-1)
+        self.assertEqual((backend.get('a'), backend.get('b')), (1, None))
@@ -0,0 +1,61 @@
+""" Benchmark: building filter criteria
+
+    $ python -m tests.benchmarks.criteria
+"""
+from __future__ import print_function
+
+from timeit import Timer
+
+from mongosql import MongoModel
+from mongosql.statements import MongoCriteria
+
+from .. import models
+
+
+def deep_or(branches):
+    """ Article filter with many $or branches over plain and JSON columns """
+    return {'$or': [
+        {'id': {'$gt': i, '$lte': i + 10},
+         'title': {'$in': ['a', 'b', str(i)]},
+         'uid': i,
+         'data.rating': {'$gte': i},
+         '$not': {'theme': {'$exists': False}}}
+        for i in range(branches)
+    ]}
+
+
+def deep_or_arrays(branches):
+    """ User filter with many $or branches over array columns """
+    return {'$or': [
+        {'tags': {'$all': ['a', str(i)], '$ne': 'b'}, 'age': {'$lt': i}}
+        for i in range(branches)
+    ]}
+
+
+def bench(name, func, number):
+    best = min(Timer(func).repeat(repeat=7, number=number)) / number
+    print('{:<24} {:>10.2f} us'.format(name, best * 1e6))
+
+
+def main():
+    article_bag = MongoModel.get_for(models.Article).model_bag
+    user_bag = MongoModel.get_for(models.User).model_bag
+
+    # Operator resolution alone: the handler returns a constant, so no SQL expression is built
+    MongoCriteria.custom_op('$const', lambda col, value: True)
+    title = MongoCriteria.get_column(article_bag, 'title')
+    bench('dispatch: custom op', lambda: MongoCriteria.get_condition('$const', title, 1), 20000)
+
+    # Complete statements
+    cases = [
+        ('scalar equality', article_bag, {'id': 1, 'uid': 2, 'title': 'a'}),
+        ('$or x10', article_bag, deep_or(10)),
+        ('$or x50', article_bag, deep_or(50)),
+        ('$or x50, arrays', user_bag, deep_or_arrays(50)),
+    ]
+    for name, bag, criteria in cases:
+        bench(name, lambda: MongoCriteria.statement(bag, criteria), 200)
+
+
+if __name__ == '__main__':
+    main()
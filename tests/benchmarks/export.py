@@ -0,0 +1,113 @@
+""" Benchmark: exporting a large list: rows per second and peak memory
+
+    Fills a separate schema of the test database with articles, then exports them in a separate process per mode,
+    so that every mode has its own peak RSS. The tables of the test suite are left alone.
+
+    $ python -m tests.benchmarks.export [rows]
+"""
+from __future__ import print_function
+
+import json
+import resource
+import subprocess
+import sys
+from timeit import default_timer as timer
+
+from sqlalchemy import event
+
+from mongosql import CrudHelper, CrudViewMixin
+from mongosql.export import QueryExport
+
+from .. import models
+
+
+QUERY_OBJ = {'project': ['id', 'uid', 'title', 'data'], 'sort': ['id+']}
+
+#: The schema to fill: the only one on the search path
+SCHEMA = 'mongosql_benchmark'
+
+
+class NullSink(object):
+    """ Binary sink that only counts bytes """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class ArticlesExport(CrudViewMixin):
+    crudhelper = CrudHelper(models.Article)
+
+    def __init__(self, ssn):
+        super(ArticlesExport, self).__init__()
+        self.ssn = ssn
+
+    def _query(self):
+        return self.ssn.query(models.Article)
+
+
+def init_database():
+    """ Init DB: work in the benchmark schema """
+    engine, Session = models.init_database()
+
+    @event.listens_for(engine, 'connect')
+    def set_search_path(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET search_path TO ' + SCHEMA)
+        cursor.close()
+
+    return engine, Session
+
+
+def fill(n):
+    """ Create tables with `n` articles """
+    engine, Session = init_database()
+    engine.execute('CREATE SCHEMA IF NOT EXISTS ' + SCHEMA)
+    models.drop_all(engine)
+    models.create_all(engine)
+    engine.execute(models.User.__table__.insert(), [{'id': 1, 'name': 'a', 'age': 18, 'tags': ['a']}])
+    for start in range(0, n, 10000):
+        engine.execute(models.Article.__table__.insert(), [
+            {'id': i, 'uid': 1, 'title': 'Article #{}'.format(i), 'data': {'rating': i % 10, 'o': {'a': True}}}
+            for i in range(start, min(n, start + 10000))
+        ])
+
+
+def run(mode):
+    """ Export all articles; print (rows, bytes, seconds, peak RSS in KiB) """
+    engine, Session = init_database()
+    ssn = Session()
+    view = ArticlesExport(ssn)
+    sink = NullSink()
+
+    started = timer()
+    if mode == 'list':
+        # The old way: load everything, project, encode a single list
+        rows, projection = view._method_list(dict(QUERY_OBJ))
+        data = [{k: getattr(row, k) for k in projection} for row in rows]
+        sink.write(json.dumps(data).encode('utf-8'))
+        n = len(rows)
+    else:
+        format, _, compress = mode.partition('.')
+        n = view._method_export(sink, QueryExport(format, compress=bool(compress)), dict(QUERY_OBJ))
+    seconds = timer() - started
+
+    print(json.dumps([n, sink.size, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))
+
+
+def main(n=200000):
+    fill(n)
+    for mode in ('list', 'ndjson', 'csv', 'ndjson.gz', 'csv.gz'):
+        out = subprocess.check_output([sys.executable, '-m', 'tests.benchmarks.export', '--run', mode])
+        rows, size, seconds, rss = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        print('{:<10} {:>10.0f} rows/s {:>8.1f} MiB out {:>8.1f} MiB peak RSS'.format(
+            mode, rows / seconds, size / 2.0 ** 20, rss / 1024.0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--run':
+        run(sys.argv[2])
+    else:
+        main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,36 @@
+""" Benchmark: building queries with nested joins
+
+    $ python -m tests.benchmarks.joins
+"""
+from __future__ import print_function
+
+from timeit import Timer
+
+from sqlalchemy.orm import Query
+
+from .. import models
+
+
+#: Relations to follow, starting from User: user -> articles -> comments -> user -> articles -> ...
+PATH = ('articles', 'comments', 'user')
+
+
+def nested_join(depth, join_func='join'):
+    """ Query Object with `depth` levels of joins, each with a filter """
+    query_obj = {'filter': {'id': {'$gt': 0}}}
+    for i in reversed(range(depth)):
+        query_obj = {'filter': {'id': {'$gt': 0}}, join_func: {PATH[i % len(PATH)]: query_obj}}
+    return query_obj
+
+
+def main(number=100):
+    for join_func in ('join', 'outerjoin'):
+        for depth in range(1, 7):
+            query_obj = nested_join(depth, join_func)
+            build = lambda: models.User.mongoquery(Query([models.User])).query(**query_obj).end()
+            best = min(Timer(build).repeat(repeat=5, number=number)) / number
+            print('{} depth {}: {:>10.1f} us'.format(join_func, depth, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
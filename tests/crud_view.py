@@ -1,23 +1,10 @@
 from mongosql import CrudViewMixin, StrictCrudHelper
-import collections
 
 from . import models
 from flask import request, g
 from flask_jsontools import jsonapi, RestfulView
 
 
-def project(item, projection):
-    result = {}
-    if isinstance(item, collections.Iterable):
-        return [project(i, projection) for i in item]
-    for key, value in projection.items():
-        if isinstance(value, dict):
-            result[key] = project(getattr(item, key, None), value)
-        if value == 1:
-            result[key] = getattr(item, key, None)
-    return result
-
-
 class ArticlesView(RestfulView, CrudViewMixin):
     """ Full-featured CRUD view """
 
@@ -29,6 +16,7 @@ class ArticlesView(RestfulView, CrudViewMixin):
             'sort': ['id-'],
         },
         maxitems=2,
+        count_estimate=1000,
     )
 
     # RestfulView needs that for routing
@@ -60,8 +48,12 @@ class ArticlesView(RestfulView, CrudViewMixin):
 
     def list(self):
         data, projection = self._method_list(self._qo)
-        if projection:
-            data = project(data, projection)
+        total = None
+        if (self._qo or {}).get('with_total'):
+            data, total = data
+        data = self._serialize(data, projection)
+        if total is not None:
+            return { self.entity_name+'s':  data, 'total': total}
         return { self.entity_name+'s':  data}
 
     def create(self):
@@ -80,8 +72,7 @@ class ArticlesView(RestfulView, CrudViewMixin):
 
     def get(self, id):
         item, projection = self._method_get(self._qo, id=id)
-        if projection:
-            item = project(item, projection)
+        item = self._serialize(item, projection)
         return { self.entity_name:  item }
 
     def update(self, id):